@@ -0,0 +1,195 @@
+"""Локальные заглушки Telegram Bot API и Supabase REST для нагрузочных прогонов"""
+import asyncio
+import json
+import random
+import re
+import time
+from collections import deque
+from typing import Dict, List, Optional, Set, Tuple
+
+from aiohttp import web
+
+# or=(user_id.gt.N,and(user_id.eq.N,item_name.gt."name")) — keyset-страница SupabaseDB.iter_pages
+KEYSET_RE = re.compile(r'\(user_id\.gt\.(\d+),and\(user_id\.eq\.\d+,item_name\.gt\."(.*)"\)\)')
+# in.(1,2) и in.("Mango","Frost Blower") — удаление пачкой в delete_users и flush_user_toggles
+IN_VALUE_RE = re.compile(r'"((?:[^"\\]|\\.)*)"|([^,]+)')
+
+class FakeTelegram:
+    """Bot API с настраиваемой задержкой, ответами 429 и заблокированными пользователями.
+
+    server_rate ограничивает число sendMessage в секунду, как это делает сам Telegram;
+    retry_chance добавляет случайные 429 поверх лимита.
+    """
+    def __init__(self, latency: float = 0.05, jitter: float = 0.02, retry_chance: float = 0.0,
+                 retry_after: int = 1, server_rate: Optional[float] = None,
+                 blocked: Optional[Set[int]] = None, seed: int = 0):
+        self.latency = latency
+        self.jitter = jitter
+        self.retry_chance = retry_chance
+        self.retry_after = retry_after
+        self.server_rate = server_rate
+        self.blocked: Set[int] = blocked or set()
+        self.rng = random.Random(seed)
+        self.window: deque = deque()
+        self.message_id = 0
+        self.reset()
+
+    def reset(self):
+        # (момент ответа по time.monotonic(), chat_id) для каждого доставленного сообщения
+        self.deliveries: List[Tuple[float, int]] = []
+        self.retry_responses = 0
+        self.blocked_responses = 0
+        self.requests = 0
+
+    async def _params(self, request: web.Request) -> Dict:
+        if request.content_type == "application/json":
+            return await request.json()
+        return dict(await request.post())
+
+    def _over_limit(self, now: float) -> bool:
+        if self.server_rate is None:
+            return False
+        while self.window and now - self.window[0] >= 1.0:
+            self.window.popleft()
+        if len(self.window) >= self.server_rate:
+            return True
+        self.window.append(now)
+        return False
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        params = await self._params(request)
+        self.requests += 1
+
+        if method == "getMe":
+            return web.json_response({"ok": True, "result": {
+                "id": 123456, "is_bot": True, "first_name": "Bench", "username": "pvb_bench_bot",
+                "can_join_groups": False, "can_read_all_group_messages": False, "supports_inline_queries": False
+            }})
+
+        if method == "getChatMember":
+            return web.json_response({"ok": True, "result": {
+                "status": "member",
+                "user": {"id": int(params.get("user_id", 0)), "is_bot": False, "first_name": "User"}
+            }})
+
+        if method != "sendMessage":
+            return web.json_response({"ok": True, "result": True})
+
+        await asyncio.sleep(max(0.0, self.latency + self.rng.uniform(-self.jitter, self.jitter)))
+        now = time.monotonic()
+
+        if self._over_limit(now) or self.rng.random() < self.retry_chance:
+            self.retry_responses += 1
+            return web.json_response({
+                "ok": False, "error_code": 429,
+                "description": f"Too Many Requests: retry after {self.retry_after}",
+                "parameters": {"retry_after": self.retry_after}
+            }, status=429)
+
+        chat_id = params.get("chat_id")
+        if isinstance(chat_id, str) and chat_id.lstrip("-").isdigit():
+            chat_id = int(chat_id)
+        if chat_id in self.blocked:
+            self.blocked_responses += 1
+            return web.json_response({
+                "ok": False, "error_code": 403, "description": "Forbidden: bot was blocked by the user"
+            }, status=403)
+
+        self.message_id += 1
+        self.deliveries.append((now, chat_id))
+        return web.json_response({"ok": True, "result": {
+            "message_id": self.message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "text": params.get("text", "")
+        }})
+
+    def build_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        return app
+
+class FakeSupabase:
+    """PostgREST-подобные ответы для user_autostocks и bot_users"""
+    def __init__(self, autostocks: List[Tuple[int, str]], latency: float = 0.005):
+        self.autostocks = sorted(autostocks)
+        self.latency = latency
+        self.requests = 0
+
+    def _filter(self, rows: List[Tuple[int, str]], query) -> List[Tuple[int, str]]:
+        for column, position in (("user_id", 0), ("item_name", 1)):
+            condition = query.get(column)
+            if not condition:
+                continue
+            op, _, value = condition.partition(".")
+            if op == "in":
+                values = {quoted or plain for quoted, plain in IN_VALUE_RE.findall(value[1:-1])}
+                if position == 0:
+                    values = {int(item) for item in values}
+                rows = [row for row in rows if row[position] in values]
+                continue
+            if position == 0:
+                value = int(value)
+            if op == "eq":
+                rows = [row for row in rows if row[position] == value]
+            elif op == "gt":
+                rows = [row for row in rows if row[position] > value]
+            else:
+                raise ValueError(f"фильтр {column}={condition} не поддерживается заглушкой")
+        keyset = KEYSET_RE.fullmatch(query.get("or", ""))
+        if keyset:
+            after = (int(keyset.group(1)), keyset.group(2))
+            rows = [row for row in rows if row > after]
+        return rows
+
+    async def autostocks_get(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        await asyncio.sleep(self.latency)
+        query = request.query
+        rows = self._filter(self.autostocks, query)
+        offset = int(query.get("offset", 0))
+        limit = int(query.get("limit", len(rows)))
+        columns = query.get("select", "user_id,item_name").split(",")
+        result = [
+            {column: row[0] if column == "user_id" else row[1] for column in columns}
+            for row in rows[offset:offset + limit]
+        ]
+        return web.Response(text=json.dumps(result), content_type="application/json")
+
+    async def autostocks_delete(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        doomed = set(self._filter(self.autostocks, request.query))
+        self.autostocks = [row for row in self.autostocks if row not in doomed]
+        return web.Response(status=204)
+
+    async def autostocks_post(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        await asyncio.sleep(self.latency)
+        body = await request.json()
+        rows = {(row["user_id"], row["item_name"]) for row in (body if isinstance(body, list) else [body])}
+        existing = set(self.autostocks)
+        # Как PostgREST: дубликат по первичному ключу без resolution=... — 409
+        if rows & existing and "resolution=" not in request.headers.get("Prefer", ""):
+            return web.json_response({"code": "23505", "message": "duplicate key value"}, status=409)
+        self.autostocks = sorted(existing | rows)
+        return web.Response(status=201)
+    
+    async def accepted(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        await asyncio.sleep(self.latency)
+        return web.Response(status=201 if request.method == "POST" else 204)
+
+    def build_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get("/rest/v1/user_autostocks", self.autostocks_get)
+        app.router.add_delete("/rest/v1/user_autostocks", self.autostocks_delete)
+        app.router.add_post("/rest/v1/user_autostocks", self.autostocks_post)
+        app.router.add_route("*", "/rest/v1/bot_users", self.accepted)
+        return app
+
+async def start_site(app: web.Application, port: int) -> web.AppRunner:
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    return runner
\ No newline at end of file
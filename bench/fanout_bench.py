@@ -0,0 +1,247 @@
+"""Нагрузочный прогон fan-out: корпус restock → check_user_autostocks → заглушки Telegram и Supabase.
+
+Реальные пользователи не затрагиваются: бот ходит только на 127.0.0.1.
+
+    python bench/fanout_bench.py --users 10000
+    python bench/fanout_bench.py --users 100000 --rate 1000 --retry-chance 0.01 --blocked 0.02
+    python bench/fanout_bench.py --users 10000 --save-baseline bench/baselines/fanout_10k.json
+    python bench/fanout_bench.py --users 10000 --baseline bench/baselines/fanout_10k.json
+
+Лимит отправки по умолчанию выше продового TELEGRAM_GLOBAL_RATE, чтобы прогон
+показывал потолок самого пайплайна; --rate 28 воспроизводит боевой режим.
+
+Корпус bench/restock_embeds.json синтетический: embed'ы сгенерированы в формате
+PVB Stock Notifier, а не выгружены из канала.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import resource
+import socket
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Dict, List, Set, Tuple
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+
+from fakes import FakeSupabase, FakeTelegram, start_site
+
+CORPUS_PATH = os.path.join(BENCH_DIR, "restock_embeds.json")
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def percentile(values: List[float], fraction: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def load_corpus() -> List[Dict]:
+    with open(CORPUS_PATH, "r", encoding="utf-8") as f:
+        return json.load(f)["messages"]
+
+def generate_autostocks(users: int, item_names: List[str], rare_items: Set[str], seed: int) -> List[Tuple[int, str]]:
+    """Подписки, похожие на боевые: 1–6 предметов на пользователя, редкие отслеживают чаще"""
+    rng = random.Random(seed)
+    weights = [4.0 if name in rare_items else 1.0 + position / len(item_names) for position, name in enumerate(item_names)]
+    rows = []
+    for user_id in range(10_000_000, 10_000_000 + users):
+        tracked = set(rng.choices(item_names, weights=weights, k=rng.randint(1, 6)))
+        rows.extend((user_id, name) for name in tracked)
+    return rows
+
+def configure_environment(supabase_port: int, workdir: str):
+    """Окружение для импорта bot.py: фиктивные токены и Supabase на localhost"""
+    os.environ.update({
+        "BOT_TOKEN": "123456:bench-token",
+        "DISCORD_TOKEN": "bench-token",
+        "SUPABASE_URL": f"http://127.0.0.1:{supabase_port}",
+        "SUPABASE_KEY": "bench-key",
+        "WEBHOOK_URL": "",
+        "NOTIFICATION_CHANNEL_ID": "",
+        # Процессы fan-out создают свой Bot с боевым адресом API — в стенде только основной процесс
+        "FANOUT_WORKER_PROCESSES": "0",
+        "RESTOCK_DEDUP_FILE": os.path.join(workdir, "processed_restocks.json"),
+        "RESTOCK_HISTORY_DB": os.path.join(workdir, "restock_history.db"),
+    })
+
+async def run(args) -> Dict:
+    telegram_port = free_port()
+    supabase_port = free_port()
+    workdir = tempfile.mkdtemp(prefix="pvb-bench-")
+    configure_environment(supabase_port, workdir)
+
+    import bot
+    import discord
+    from telegram import Bot
+    from telegram.request import HTTPXRequest
+
+    logging.getLogger().setLevel(logging.WARNING)
+    bot.logger.setLevel(logging.WARNING)
+    bot.build_item_id_mappings()
+    bot.build_item_resolver()
+
+    autostocks = generate_autostocks(args.users, list(bot.ITEMS_DATA), set(bot.NOTIFICATION_ITEMS), args.seed)
+    rng = random.Random(args.seed)
+    blocked = {user_id for user_id in range(10_000_000, 10_000_000 + args.users) if rng.random() < args.blocked}
+
+    fake_telegram = FakeTelegram(
+        latency=args.latency, jitter=args.jitter, retry_chance=args.retry_chance,
+        server_rate=args.server_rate, blocked=blocked, seed=args.seed
+    )
+    fake_supabase = FakeSupabase(autostocks)
+    runners = [
+        await start_site(fake_telegram.build_app(), telegram_port),
+        await start_site(fake_supabase.build_app(), supabase_port),
+    ]
+
+    bot.notification_dispatcher = bot.NotificationDispatcher(args.rate, bot.DISPATCH_QUEUE_SIZE, args.workers)
+    telegram_bot = Bot(
+        bot.BOT_TOKEN,
+        base_url=f"http://127.0.0.1:{telegram_port}/bot",
+        request=HTTPXRequest(connection_pool_size=args.workers + 8)
+    )
+    await telegram_bot.initialize()
+
+    index_started = time.perf_counter()
+    if not await bot.parser.db.reload_subscriber_index():
+        raise RuntimeError("индекс подписчиков не загрузился из заглушки Supabase")
+    index_seconds = time.perf_counter() - index_started
+
+    corpus = load_corpus()
+    if args.trace_memory:
+        tracemalloc.start()
+
+    runs = []
+    latencies: List[float] = []
+    for number in range(args.restocks):
+        message = corpus[number % len(corpus)]
+        embeds = [discord.Embed.from_dict(embed) for embed in message["embeds"]]
+
+        # Каждый прогон — как первый restock после простоя: кулдауны пустые
+        bot.user_sent_notifications = bot.CooldownStore(bot.USER_NOTIFICATION_COOLDOWN)
+        bot.item_last_seen = bot.CooldownStore(bot.ITEM_NOTIFY_COOLDOWN)
+        fake_telegram.reset()
+        if args.trace_memory:
+            tracemalloc.reset_peak()
+
+        received_at = time.monotonic()
+        stock_data = bot.parser.parse_stock_message(message["content"], embeds)
+        await bot.parser.check_user_autostocks(stock_data, telegram_bot, received_at)
+        elapsed = time.monotonic() - received_at
+
+        delivered = [delivered_at - received_at for delivered_at, _ in fake_telegram.deliveries]
+        latencies.extend(delivered)
+        runs.append({
+            "message_id": message["id"],
+            "items": len(stock_data["seeds"]) + len(stock_data["gear"]),
+            "sent": len(delivered),
+            "retry_after": fake_telegram.retry_responses,
+            "blocked": fake_telegram.blocked_responses,
+            "seconds": round(elapsed, 3),
+            "sends_per_second": round(len(delivered) / elapsed, 1) if elapsed else 0.0,
+            "tracemalloc_peak_mb": round(tracemalloc.get_traced_memory()[1] / 2**20, 2) if args.trace_memory else None,
+        })
+        print(f"restock {number + 1}/{args.restocks}: {runs[-1]}", file=sys.stderr)
+
+    await bot.notification_dispatcher.stop()
+    await telegram_bot.shutdown()
+    if bot.http_session and not bot.http_session.closed:
+        await bot.http_session.close()
+    for runner in runners:
+        await runner.cleanup()
+
+    total_sent = sum(entry["sent"] for entry in runs)
+    total_seconds = sum(entry["seconds"] for entry in runs)
+    return {
+        "config": {
+            "users": args.users,
+            "subscriptions": len(autostocks),
+            "restocks": args.restocks,
+            "rate": args.rate,
+            "workers": args.workers,
+            "latency": args.latency,
+            "retry_chance": args.retry_chance,
+            "server_rate": args.server_rate,
+            "blocked": args.blocked,
+        },
+        "index_load_seconds": round(index_seconds, 3),
+        "sent": total_sent,
+        "retry_after": sum(entry["retry_after"] for entry in runs),
+        "blocked": sum(entry["blocked"] for entry in runs),
+        "throughput_per_second": round(total_sent / total_seconds, 1) if total_seconds else 0.0,
+        "delivery_latency_seconds": {
+            "p50": round(percentile(latencies, 0.50), 3),
+            "p90": round(percentile(latencies, 0.90), 3),
+            "p99": round(percentile(latencies, 0.99), 3),
+            "max": round(max(latencies, default=0.0), 3),
+        },
+        "fanout_seconds_max": max((entry["seconds"] for entry in runs), default=0.0),
+        "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "tracemalloc_peak_mb": max((entry["tracemalloc_peak_mb"] or 0.0 for entry in runs), default=0.0) if args.trace_memory else None,
+        "runs": runs,
+    }
+
+def compare(report: Dict, baseline: Dict, tolerance: float) -> List[str]:
+    """Регрессии относительно сохранённого прогона"""
+    regressions = []
+    old, new = baseline["throughput_per_second"], report["throughput_per_second"]
+    if old and new < old * (1 - tolerance):
+        regressions.append(f"throughput {new}/s < baseline {old}/s")
+    for key in ("p99", "max"):
+        old, new = baseline["delivery_latency_seconds"][key], report["delivery_latency_seconds"][key]
+        if old and new > old * (1 + tolerance):
+            regressions.append(f"delivery {key} {new}s > baseline {old}s")
+    old, new = baseline["max_rss_mb"], report["max_rss_mb"]
+    if old and new > old * (1 + tolerance):
+        regressions.append(f"max RSS {new}MB > baseline {old}MB")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=10_000)
+    parser.add_argument("--restocks", type=int, default=3)
+    parser.add_argument("--rate", type=float, default=1000, help="лимит отправки бота, сообщений/сек")
+    parser.add_argument("--workers", type=int, default=30)
+    parser.add_argument("--latency", type=float, default=0.05, help="задержка ответа Telegram, сек")
+    parser.add_argument("--jitter", type=float, default=0.02)
+    parser.add_argument("--retry-chance", type=float, default=0.0, help="доля случайных ответов 429")
+    parser.add_argument("--server-rate", type=float, default=None, help="лимит заглушки Telegram, сообщений/сек")
+    parser.add_argument("--blocked", type=float, default=0.0, help="доля пользователей, заблокировавших бота")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--trace-memory", action="store_true", help="пиковая память по tracemalloc (медленнее)")
+    parser.add_argument("--save-baseline", metavar="PATH")
+    parser.add_argument("--baseline", metavar="PATH")
+    parser.add_argument("--tolerance", type=float, default=0.15)
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    print(json.dumps({key: value for key, value in report.items() if key != "runs"}, ensure_ascii=False, indent=2))
+
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(os.path.abspath(args.save_baseline)), exist_ok=True)
+        with open(args.save_baseline, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        if baseline["config"] != report["config"]:
+            print("⚠️ baseline снят с другими параметрами", file=sys.stderr)
+        regressions = compare(report, baseline, args.tolerance)
+        for line in regressions:
+            print(f"❌ {line}", file=sys.stderr)
+        sys.exit(1 if regressions else 0)
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file
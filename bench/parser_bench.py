@@ -0,0 +1,168 @@
+"""Микробенчмарки горячего пути restock: парсинг embed'ов, нормализация имён и сборка сообщений.
+
+Каждый случай прогоняется --repeat раз по --number вызовов; в отчёт идёт лучший
+прогон (как у timeit) и медиана, в микросекундах на вызов.
+
+    python bench/parser_bench.py
+    python bench/parser_bench.py --save-baseline bench/baselines/parser.json
+    python bench/parser_bench.py --baseline bench/baselines/parser.json
+
+Логирование на время замеров отключено: считается стоимость самого кода.
+Корпус синтетический (см. bench/restock_embeds.json); пограничные случаи помечены полем "case".
+"""
+import argparse
+import json
+import logging
+import os
+import statistics
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, Tuple
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+
+from fanout_bench import configure_environment, load_corpus
+
+# Типичный пользователь отслеживает несколько предметов, часть из них — в текущем стоке
+USER_MESSAGE_SIZES = (1, 3, 6)
+
+def measure(func: Callable[[], object], number: int, repeat: int) -> Dict[str, float]:
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter_ns()
+        for _ in range(number):
+            func()
+        timings.append((time.perf_counter_ns() - started) / number / 1000)
+    return {"best_us": round(min(timings), 3), "median_us": round(statistics.median(timings), 3)}
+
+def build_cases(bot, discord) -> Tuple[Dict[str, Callable[[], object]], int, int, int]:
+    parser = bot.parser
+    messages = [
+        (message["content"], [discord.Embed.from_dict(embed) for embed in message["embeds"]])
+        for message in load_corpus()
+    ]
+    field_names = [field.name for _, embeds in messages for embed in embeds for field in embed.fields]
+    parsed = [parser.parse_stock_message(content, embeds) for content, embeds in messages]
+
+    def parse_corpus():
+        for content, embeds in messages:
+            parser.parse_stock_message(content, embeds)
+
+    def parse_corpus_cold():
+        # Пустой memo резолвера — как первый restock после старта
+        bot.build_item_resolver()
+        parse_corpus()
+
+    def normalize_fields():
+        for name in field_names:
+            parser.normalize_item_name(name)
+
+    def resolve_fields():
+        for name in field_names:
+            bot.item_resolver.resolve_field(name)
+
+    def format_stock():
+        for stock_data in parsed:
+            parser.format_stock_message(stock_data)
+
+    def render_stock_body():
+        for stock_data in parsed:
+            parser.render_stock_body(stock_data)
+
+    # Как в check_user_autostocks: маска пользователя → список предметов → текст
+    largest = max(parsed, key=lambda stock_data: len(stock_data["seeds"]) + len(stock_data["gear"]))
+    notify_bits = [(bot.ITEM_BITS[name], name, count) for name, count in largest["seeds"] + largest["gear"]]
+    user_masks = []
+    for size in USER_MESSAGE_SIZES:
+        mask = 0
+        for bit, _, _ in notify_bits[-size:]:
+            mask |= bit
+        user_masks.append(mask)
+
+    def build_user_messages():
+        for mask in user_masks:
+            items = [(name, count) for bit, name, count in notify_bits if mask & bit]
+            parser.format_autostock_message(items)
+
+    cases = {
+        "parse_stock_message/corpus": parse_corpus,
+        "parse_stock_message/corpus_cold_resolver": parse_corpus_cold,
+        "normalize_item_name/corpus_fields": normalize_fields,
+        "resolve_field/corpus_fields": resolve_fields,
+        "format_stock_message/corpus": format_stock,
+        "render_stock_body/corpus": render_stock_body,
+        "user_message/per_user": build_user_messages,
+    }
+    return cases, len(messages), len(field_names), len(user_masks)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--number", type=int, default=200)
+    parser.add_argument("--repeat", type=int, default=7)
+    parser.add_argument("--save-baseline", metavar="PATH")
+    parser.add_argument("--baseline", metavar="PATH")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="допустимое замедление относительно baseline")
+    args = parser.parse_args()
+
+    configure_environment(0, tempfile.mkdtemp(prefix="pvb-bench-"))
+    import bot
+    import discord
+
+    logging.disable(logging.CRITICAL)
+    bot.build_item_id_mappings()
+    bot.build_item_resolver()
+
+    cases, restocks, fields, users = build_cases(bot, discord)
+    # Сколько вызовов делает один прогон случая: для пересчёта в «на вызов»
+    per_call = {
+        "parse_stock_message/corpus": restocks,
+        "parse_stock_message/corpus_cold_resolver": restocks,
+        "normalize_item_name/corpus_fields": fields,
+        "resolve_field/corpus_fields": fields,
+        "format_stock_message/corpus": restocks,
+        "render_stock_body/corpus": restocks,
+        "user_message/per_user": users,
+    }
+
+    results = {}
+    for name, func in cases.items():
+        func()  # прогрев
+        timing = measure(func, args.number, args.repeat)
+        divisor = per_call[name]
+        results[name] = {
+            "per_call_us": round(timing["best_us"] / divisor, 3),
+            "per_call_median_us": round(timing["median_us"] / divisor, 3),
+            "per_restock_us": None if name.startswith("user_message") else round(timing["best_us"] / restocks, 3),
+        }
+        print(f"{name:45s} {results[name]['per_call_us']:10.3f} µs/call", file=sys.stderr)
+
+    report = {
+        "python": sys.version.split()[0],
+        "corpus": {"restocks": restocks, "fields": fields},
+        "results": results,
+    }
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(os.path.abspath(args.save_baseline)), exist_ok=True)
+        with open(args.save_baseline, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        if baseline["corpus"] != report["corpus"]:
+            print("⚠️ baseline снят на другом корпусе", file=sys.stderr)
+        regressions = []
+        for name, result in results.items():
+            old = baseline["results"].get(name)
+            if old and result["per_call_us"] > old["per_call_us"] * (1 + args.tolerance):
+                regressions.append(f"{name}: {result['per_call_us']} µs > baseline {old['per_call_us']} µs")
+        for line in regressions:
+            print(f"❌ {line}", file=sys.stderr)
+        sys.exit(1 if regressions else 0)
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file
@@ -0,0 +1,72 @@
+"""Проверка webhook-эндпоинта: локальный «Telegram» шлёт апдейты в build_http_app().
+
+Сеть наружу не нужна: Application только собирается, апдейты читаются из update_queue.
+
+    python bench/webhook_check.py
+"""
+import asyncio
+import json
+import os
+import sys
+import tempfile
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+
+from fakes import start_site
+from fanout_bench import configure_environment, free_port
+
+def sample_update(update_id: int) -> dict:
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": 1,
+            "date": 1760000000,
+            "chat": {"id": 42, "type": "private"},
+            "from": {"id": 42, "is_bot": False, "first_name": "User"},
+            "text": "/stock",
+        },
+    }
+
+async def run() -> int:
+    configure_environment(0, tempfile.mkdtemp(prefix="pvb-bench-"))
+    import aiohttp
+    import bot
+    from telegram.ext import Application
+
+    bot.telegram_app = Application.builder().token(bot.BOT_TOKEN).updater(None).build()
+    port = free_port()
+    runner = await start_site(bot.build_http_app(), port)
+    url = f"http://127.0.0.1:{port}{bot.WEBHOOK_PATH}"
+    good = {"X-Telegram-Bot-Api-Secret-Token": bot.WEBHOOK_SECRET, "Content-Type": "application/json"}
+    bad = {"X-Telegram-Bot-Api-Secret-Token": "wrong", "Content-Type": "application/json"}
+
+    # (описание, заголовки, тело, ожидаемый статус, update_id в очереди)
+    cases = [
+        ("верный секрет", good, json.dumps(sample_update(1001)), 200, 1001),
+        ("неверный секрет", bad, json.dumps(sample_update(1002)), 403, None),
+        ("без секрета", {"Content-Type": "application/json"}, json.dumps(sample_update(1003)), 403, None),
+        ("битый JSON", good, "{not json", 400, None),
+        ("пустое тело", good, "{}", 400, None),
+    ]
+
+    failures = 0
+    queue = bot.telegram_app.update_queue
+    async with aiohttp.ClientSession() as session:
+        for name, headers, body, status, update_id in cases:
+            async with session.post(url, data=body, headers=headers) as response:
+                got_status = response.status
+            queued = queue.get_nowait().update_id if not queue.empty() else None
+            ok = got_status == status and queued == update_id
+            failures += not ok
+            print(f"{'✅' if ok else '❌'} {name}: HTTP {got_status} (ожидалось {status}), в очереди {queued}")
+
+    await runner.cleanup()
+    return failures
+
+def main():
+    sys.exit(1 if asyncio.run(run()) else 0)
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file
@@ -2,19 +2,32 @@ import asyncio
 import logging
 import os
 import hashlib
+import hmac
+import json
 import re
+import shutil
+import signal
+import sqlite3
+import tempfile
+import time
+from contextlib import contextmanager
+from bisect import bisect_left
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime, timedelta
-from typing import Dict, Optional, List, Set, Tuple
+from types import MappingProxyType
+from typing import Dict, Optional, List, Set, Tuple, Hashable, Iterable, AsyncIterator
 from telegram import Update, Bot, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, ContextTypes, CallbackQueryHandler
+from telegram.ext import Application, CommandHandler, ContextTypes, CallbackQueryHandler, BaseRateLimiter
+from telegram.request import HTTPXRequest
 from telegram.constants import ParseMode, ChatType
-from telegram.error import TelegramError
+from telegram.error import TelegramError, RetryAfter
 import pytz
 from dotenv import load_dotenv
 import discord
 import aiohttp
-from flask import Flask, jsonify, request as flask_request
-import threading
+from aiohttp import web
 
 load_dotenv()
 
@@ -35,12 +48,61 @@ DISCORD_STOCK_CHANNEL_ID = 1407975317682917457
 
 STOCK_CACHE_SECONDS = 15
 USER_NOTIFICATION_COOLDOWN = 120
+ITEM_NOTIFY_COOLDOWN = 90
+COOLDOWN_WHEEL_RESOLUTION = 5
 AUTOSTOCK_CACHE_TTL = 120
+AUTOSTOCK_CACHE_MAX = 20000
 SUBSCRIPTION_CACHE_TTL = 180
+SUBSCRIPTION_NEGATIVE_CACHE_TTL = 30
+SUBSCRIPTION_CACHE_MAX = 50000
+SUBSCRIBER_INDEX_RECONCILE_SECONDS = 600
+KEYBOARD_CACHE_LIMIT = 4096
+USERS_FLUSH_BATCH = 200
+USERS_FLUSH_SECONDS = 10
+DB_PAGE_SIZE = 1000
+AUTOSTOCK_TOGGLE_DEBOUNCE_SECONDS = 3
+# Сколько раз подряд повторять запись переключений, которую Supabase отклоняет с 4xx
+AUTOSTOCK_TOGGLE_MAX_REJECTIONS = 3
+# Дедупликация restock: ID сообщений хранятся ограниченно, хэши содержимого — в пределах окна
+RESTOCK_DEDUP_FILE = os.getenv("RESTOCK_DEDUP_FILE", "processed_restocks.json")
+RESTOCK_DEDUP_MAX_IDS = 2000
+RESTOCK_DUPLICATE_WINDOW = 240
+RESTOCK_HISTORY_DB = os.getenv("RESTOCK_HISTORY_DB", "restock_history.db")
+# Прогрев при старте: подписки недавно активных пользователей
+WARMUP_SUBSCRIPTION_USERS = 300
+WARMUP_CONCURRENCY = 8
+# Рассылка /broadcast: контрольная точка, частота отчёта админу, пачка удаления заблокировавших
+BROADCAST_CHECKPOINT_FILE = os.getenv("BROADCAST_CHECKPOINT_FILE", "broadcast_checkpoint.json")
+BROADCAST_PROGRESS_SECONDS = 5
+BROADCAST_PRUNE_BATCH = 100
+# Своя очередь рассылки: не занимает места в очереди уведомлений о стоке
+BROADCAST_QUEUE_SIZE = 200
+BROADCAST_WORKERS = 8
+
+# Глобальный лимит Telegram ~30 сообщений/сек, держим небольшой запас
+TELEGRAM_GLOBAL_RATE = 28
+DISPATCH_QUEUE_SIZE = 1000
+DISPATCH_WORKERS = 30
+DISPATCH_MAX_RETRIES = 5
+# Раздельные пулы соединений: ответы пользователям не ждут свободного соединения за рассылкой
+INTERACTIVE_POOL_SIZE = 16
+NOTIFY_POOL_SIZE = DISPATCH_WORKERS + 4
+# Процессы fan-out: 0 — рассылка в основном event loop; N — шарды по user_id в N процессах,
+# каждый со своим пулом соединений и долей TELEGRAM_GLOBAL_RATE
+FANOUT_WORKER_PROCESSES = int(os.getenv("FANOUT_WORKER_PROCESSES", "0"))
+# Доля лимита, которую основной процесс оставляет себе, пока процессы fan-out шлют шарды:
+# ответы на команды, рассылка админа, прогрев. Остальное делится между процессами поровну.
+# Вне fan-out основной процесс снова работает на полном TELEGRAM_GLOBAL_RATE
+FANOUT_MAIN_RATE = 4
 
 if not BOT_TOKEN or not DISCORD_TOKEN:
     raise ValueError("BOT_TOKEN и DISCORD_TOKEN обязательны!")
 
+# Webhook: если задан публичный адрес, Telegram шлёт апдейты на PORT вместо long polling
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # например https://pvb-bot.onrender.com
+WEBHOOK_PATH = "/telegram/webhook"
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or hashlib.sha256(BOT_TOKEN.encode('utf-8')).hexdigest()[:32]
+
 # ========== ЛОГИРОВАНИЕ ==========
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -77,6 +139,30 @@ ITEMS_DATA = {
     "Carrot Launcher": {"emoji": "🥕", "price": "$500,000", "category": "gear"}
 }
 
+# Варианты написания в embed'ах Stock Notifier (канонические имена добавляются автоматически)
+ITEM_ALIASES = {
+    'dragon': 'Dragon Fruit',
+    'coco': 'Cocotank',
+    'carnivorous': 'Carnivorous Plant',
+    'carrot': 'Mr Carrot',
+    'tomato': 'Tomatrio',
+    'mushroom': 'Shroombino',
+    'limone': 'King Limone',
+    'king lemon': 'King Limone',
+    'lemon': 'King Limone',
+    'star': 'Starfruit',
+    'brussel': 'Brussel Sprouts',
+    'sprouts': 'Brussel Sprouts',
+    'kiwi': 'Kiwi Cannoneer',
+    'cannoneer': 'Kiwi Cannoneer',
+    'water': 'Water Bucket',
+    'bucket': 'Water Bucket',
+    'frost': 'Frost Grenade',
+    'banana': 'Banana Gun',
+    'blower': 'Frost Blower',
+    'launcher': 'Carrot Launcher'
+}
+
 NOTIFICATION_ITEMS = ["King Limone", "Starfruit", "Brussel Sprouts", "Kiwi Cannoneer"]
 
 # ID канала для публичных уведомлений о редких предметах
@@ -85,33 +171,278 @@ NOTIFICATION_CHANNEL_ID = os.getenv("NOTIFICATION_CHANNEL_ID")  # Добавь 
 SEED_ITEMS_LIST = [(name, info) for name, info in ITEMS_DATA.items() if info['category'] == 'seed']
 GEAR_ITEMS_LIST = [(name, info) for name, info in ITEMS_DATA.items() if info['category'] == 'gear']
 
+# Ключ stock_data для категории предмета: у снаряжения множественного "s" нет
+STOCK_KEYS = {"seed": "seeds", "gear": "gear"}
+
+PRICE_SUFFIXES = {"k": 10**3, "m": 10**6, "b": 10**9}
+
+def parse_price(price: str) -> float:
+    """"$1,250" → 1250, "$2.5m" → 2500000; нераспознанная цена — 0"""
+    value = price.strip().lstrip("$").replace(",", "").lower()
+    multiplier = PRICE_SUFFIXES.get(value[-1:], 1)
+    if multiplier != 1:
+        value = value[:-1]
+    try:
+        return float(value) * multiplier
+    except ValueError:
+        return 0.0
+
+# Порядок fan-out: сначала редкие предметы из NOTIFICATION_ITEMS, затем по убыванию цены
+ITEM_FANOUT_ORDER = {
+    name: (name not in NOTIFICATION_ITEMS, -parse_price(info["price"]))
+    for name, info in ITEMS_DATA.items()
+}
+
+# ========== КЭШ ==========
+class TTLCache:
+    """Кэш с лимитом размера, TTL, вытеснением LRU и счётчиками попаданий"""
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict = OrderedDict()  # key → (value, expires_at)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+    
+    def get(self, key, default=None):
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+        value, expires_at = entry
+        if expires_at <= time.monotonic():
+            del self._data[key]
+            self.expirations += 1
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+    
+    def peek(self, key, default=None):
+        """Чтение без учёта в статистике и без обновления LRU"""
+        entry = self._data.get(key)
+        if entry is None or entry[1] <= time.monotonic():
+            return default
+        return entry[0]
+    
+    def set(self, key, value, ttl: Optional[float] = None):
+        now = time.monotonic()
+        self._data[key] = (value, now + (self.ttl if ttl is None else ttl))
+        self._data.move_to_end(key)
+        
+        # Старые записи в начале: сначала выбрасываем истёкшие, затем по LRU
+        while self._data:
+            oldest_key, (_, expires_at) = next(iter(self._data.items()))
+            if expires_at <= now:
+                del self._data[oldest_key]
+                self.expirations += 1
+            elif len(self._data) > self.maxsize:
+                del self._data[oldest_key]
+                self.evictions += 1
+            else:
+                break
+    
+    def pop(self, key, default=None):
+        entry = self._data.pop(key, None)
+        return default if entry is None else entry[0]
+    
+    def __contains__(self, key) -> bool:
+        return self.peek(key) is not None
+    
+    def __len__(self) -> int:
+        return len(self._data)
+    
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+    
+    def stats_text(self) -> str:
+        return (
+            f"{len(self._data)}/{self.maxsize}, попадания {self.hit_rate():.0%} "
+            f"({self.hits}/{self.hits + self.misses}), вытеснено {self.evictions}, истекло {self.expirations}"
+        )
+
+# ========== МЕТРИКИ ==========
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+def _metric_labels(names: Tuple[str, ...], values: Tuple[str, ...]) -> str:
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        escaped = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{name}="{escaped}"')
+    return "{" + ",".join(pairs) + "}"
+
+class Counter:
+    kind = "counter"
+    
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.values: Dict[Tuple[str, ...], float] = {}
+    
+    def inc(self, amount: float = 1, labels: Tuple[str, ...] = ()):
+        self.values[labels] = self.values.get(labels, 0) + amount
+    
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        for labels, value in self.values.items():
+            lines.append(f"{self.name}{_metric_labels(self.labels, labels)} {value}")
+        return lines
+
+class Gauge(Counter):
+    kind = "gauge"
+    
+    def set(self, value: float, labels: Tuple[str, ...] = ()):
+        self.values[labels] = value
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, buckets: Tuple[float, ...] = METRICS_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+    
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+    
+    def state(self) -> Tuple[List[int], float, int]:
+        return list(self.counts), self.sum, self.count
+    
+    def merge(self, state: Tuple[List[int], float, int]):
+        """Добавляет наблюдения, собранные в другом процессе"""
+        counts, total, count = state
+        self.counts = [mine + theirs for mine, theirs in zip(self.counts, counts)]
+        self.sum += total
+        self.count += count
+    
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{{le="{bound}"}} {cumulative}')
+        lines.append(f'{self.name}_bucket{{le="+Inf"}} {self.count}')
+        lines.append(f"{self.name}_sum {self.sum}")
+        lines.append(f"{self.name}_count {self.count}")
+        return lines
+
+class BotMetrics:
+    """Метрики пути restock → уведомления в формате Prometheus"""
+    def __init__(self):
+        self.restocks = Counter("pvb_restocks_total", "Restock messages processed")
+        self.duplicate_restocks = Counter("pvb_duplicate_restocks_total", "Restock messages skipped as already processed")
+        self.parse_seconds = Histogram("pvb_restock_parse_seconds", "Time to parse a restock embed")
+        self.lookup_seconds = Histogram("pvb_subscriber_lookup_seconds", "Time to resolve subscribers of a restock")
+        self.fanout_seconds = Histogram("pvb_fanout_duration_seconds", "Time from fan-out start to the last send result")
+        self.first_delivery_seconds = Histogram("pvb_restock_first_delivery_seconds", "Discord restock to first delivered notification")
+        self.last_delivery_seconds = Histogram("pvb_restock_last_delivery_seconds", "Discord restock to last delivered notification")
+        self.send_seconds = Histogram("pvb_telegram_send_seconds", "Latency of a single Telegram send")
+        self.sends = Counter("pvb_notifications_sent_total", "Notifications delivered")
+        self.send_errors = Counter("pvb_notification_errors_total", "Notifications that failed")
+        self.fanout_rate = Gauge("pvb_fanout_sends_per_second", "Delivery rate of the last fan-out")
+        self.retry_after = Counter("pvb_telegram_retry_after_total", "Telegram 429 / RetryAfter responses")
+        self.blocked_users = Counter("pvb_blocked_users_total", "Users who blocked the bot or were deactivated")
+        self.item_recipients = Counter("pvb_item_recipients_total", "Recipients notified per item", ("item",))
+    
+    def render(self) -> str:
+        lines = []
+        for metric in vars(self).values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+metrics = BotMetrics()
+
 # ========== ГЛОБАЛЬНЫЕ ПЕРЕМЕННЫЕ ==========
 stock_cache: Optional[Dict] = None
 stock_cache_time: Optional[datetime] = None
-user_autostocks_cache: Dict[int, Set[str]] = {}
-user_autostocks_time: Dict[int, datetime] = {}
-subscription_cache: Dict[int, Tuple[bool, datetime]] = {}
-user_sent_notifications: Dict[int, Dict[str, datetime]] = {}
-item_last_seen: Dict[str, datetime] = {}
+# Сток получен через gateway и считается актуальным до следующего restock
+stock_from_gateway = False
+# Текст /stock для stock_cache: рендерится один раз, когда меняется сам сток
+stock_message_body: Optional[str] = None
+user_autostocks_cache = TTLCache(AUTOSTOCK_CACHE_MAX, AUTOSTOCK_CACHE_TTL)  # user_id → битовая маска предметов
+subscription_cache = TTLCache(SUBSCRIPTION_CACHE_MAX, SUBSCRIPTION_CACHE_TTL)  # user_id → (bool, каналы)
+subscription_inflight: Dict[int, asyncio.Task] = {}
+autostock_keyboard_cache: Dict[Tuple[str, int], InlineKeyboardMarkup] = {}
+# (chat_id, message_id) → последняя клавиатура, ожидающая отправки
+pending_markup_edits: Dict[Tuple[int, int], InlineKeyboardMarkup] = {}
 last_stock_state: Dict[str, int] = {}
 
 NAME_TO_ID: Dict[str, str] = {}
 ID_TO_NAME: Dict[str, str] = {}
+ITEM_SLOTS: Dict[str, int] = {}
+ITEM_BITS: Dict[str, int] = {}
+CATEGORY_MASKS: Dict[str, int] = {}
+item_resolver: Optional["ItemNameResolver"] = None
 
 telegram_app: Optional[Application] = None
+# Отдельный Bot для уведомлений и рассылок, со своим пулом соединений
+notify_bot: Optional[Bot] = None
 discord_client: Optional[discord.Client] = None
 http_session: Optional[aiohttp.ClientSession] = None
+background_tasks: List[asyncio.Task] = []
+fanout_pool: Optional[ProcessPoolExecutor] = None
+# Выставляется, когда Telegram принимает апдейты и может отправлять сообщения
+telegram_ready: Optional[asyncio.Event] = None
+broadcast_job = None  # BroadcastJob, пока идёт или идущая последней рассылка
+startup_timings: Dict[str, float] = {}
 
 # ========== УТИЛИТЫ ==========
+@contextmanager
+def startup_phase(name: str):
+    """Замер фазы запуска: пишет в лог и в startup_timings для /ping"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        startup_timings[name] = round(elapsed, 3)
+        logger.info(f"⏱️ {name}: {elapsed * 1000:.0f} ms")
+
+def write_json_atomic(path: str, data: Dict):
+    """Запись через временный файл: при падении на диске остаётся прежняя версия"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
 def get_moscow_time() -> datetime:
     return datetime.now(pytz.timezone('Europe/Moscow'))
 
+def items_to_mask(item_names: Iterable[str]) -> int:
+    mask = 0
+    for item_name in item_names:
+        mask |= ITEM_BITS.get(item_name, 0)
+    return mask
+
+def mask_to_items(mask: int) -> List[str]:
+    return [item_name for item_name, bit in ITEM_BITS.items() if mask & bit]
+
+def update_stock_cache(stock_data: Dict, from_gateway: bool = False, updated: Optional[datetime] = None):
+    global stock_cache, stock_cache_time, stock_from_gateway, stock_message_body
+    if stock_data != stock_cache:
+        stock_message_body = parser.render_stock_body(stock_data)
+    stock_cache = stock_data
+    stock_cache_time = updated or get_moscow_time()
+    stock_from_gateway = from_gateway
+
 def build_item_id_mappings():
     global NAME_TO_ID, ID_TO_NAME
     NAME_TO_ID.clear()
     ID_TO_NAME.clear()
+    ITEM_SLOTS.clear()
+    ITEM_BITS.clear()
+    CATEGORY_MASKS.clear()
     
-    for item_name in ITEMS_DATA.keys():
+    for slot, item_name in enumerate(ITEMS_DATA.keys()):
         hash_obj = hashlib.sha1(item_name.encode('utf-8'))
         hash_hex = hash_obj.hexdigest()[:8]
         category = ITEMS_DATA[item_name]['category']
@@ -119,30 +450,86 @@ def build_item_id_mappings():
         
         NAME_TO_ID[item_name] = safe_id
         ID_TO_NAME[safe_id] = item_name
+        ITEM_SLOTS[item_name] = slot
+        ITEM_BITS[item_name] = 1 << slot
+        CATEGORY_MASKS[category] = CATEGORY_MASKS.get(category, 0) | (1 << slot)
     
     logger.info(f"✅ Маппинг: {len(NAME_TO_ID)} предметов")
 
-async def check_subscription(user_id: int, bot: Bot, use_cache: bool = True) -> Tuple[bool, List[str]]:
-    if use_cache and user_id in subscription_cache:
-        is_subscribed, cache_time = subscription_cache[user_id]
-        now = get_moscow_time()
-        if (now - cache_time).total_seconds() < SUBSCRIPTION_CACHE_TTL:
-            return (is_subscribed, [])
-    
-    not_subscribed = []
-    for channel in REQUIRED_CHANNELS:
+# Регулярки парсера компилируются один раз
+CUSTOM_EMOJI_RE = re.compile(r'<a?:[^:]+:\d+>\s*')
+STOCK_VALUE_RE = re.compile(r'\+(\d+)\s+stock', re.IGNORECASE)
+ITEM_SUFFIX_RE = re.compile(r'\s*(seed|gun|launcher|grenade|bucket|blower)\s*', re.IGNORECASE)
+RESOLVER_MEMO_LIMIT = 1024
+
+class ItemNameResolver:
+    """Табличный резолвер названий из embed'ов в канонические имена ITEMS_DATA"""
+    def __init__(self, items: Dict[str, Dict], aliases: Dict[str, str]):
+        table = {name.lower(): name for name in items}
+        for alias, name in aliases.items():
+            table.setdefault(alias, name)
+        self.table = MappingProxyType(table)
+        # field.name → (очищенное имя, каноническое имя или None)
+        self._memo: Dict[str, Tuple[str, Optional[str]]] = {}
+    
+    def resolve(self, raw_name: str) -> Optional[str]:
+        key = " ".join(raw_name.lower().split())
+        item_name = self.table.get(key)
+        if item_name is None:
+            item_name = self.table.get(ITEM_SUFFIX_RE.sub('', key).strip())
+        return item_name
+    
+    def resolve_field(self, field_name: str) -> Tuple[str, Optional[str]]:
+        cached = self._memo.get(field_name)
+        if cached is not None:
+            return cached
+        
+        name_clean = CUSTOM_EMOJI_RE.sub('', field_name).strip()
+        result = (name_clean, self.resolve(name_clean))
+        if len(self._memo) >= RESOLVER_MEMO_LIMIT:
+            self._memo.clear()
+        self._memo[field_name] = result
+        return result
+
+def build_item_resolver():
+    global item_resolver
+    item_resolver = ItemNameResolver(ITEMS_DATA, ITEM_ALIASES)
+    logger.info(f"✅ Резолвер: {len(item_resolver.table)} вариантов названий")
+
+async def fetch_subscription(user_id: int, bot: Bot) -> Tuple[bool, Tuple[str, ...]]:
+    """Проверяет все обязательные каналы параллельно и кэширует результат"""
+    async def is_member(channel: str) -> bool:
         try:
             member = await bot.get_chat_member(chat_id=channel, user_id=user_id)
-            if member.status not in ['member', 'administrator', 'creator']:
-                not_subscribed.append(channel)
+            return member.status in ['member', 'administrator', 'creator']
         except TelegramError:
-            not_subscribed.append(channel)
+            return False
     
+    results = await asyncio.gather(*(is_member(channel) for channel in REQUIRED_CHANNELS))
+    not_subscribed = tuple(channel for channel, ok in zip(REQUIRED_CHANNELS, results) if not ok)
     is_subscribed = len(not_subscribed) == 0
-    subscription_cache[user_id] = (is_subscribed, get_moscow_time())
     
+    # Отрицательный результат живёт меньше: пользователь вот-вот подпишется
+    ttl = None if is_subscribed else SUBSCRIPTION_NEGATIVE_CACHE_TTL
+    subscription_cache.set(user_id, (is_subscribed, not_subscribed), ttl=ttl)
     return (is_subscribed, not_subscribed)
 
+async def check_subscription(user_id: int, bot: Bot, use_cache: bool = True) -> Tuple[bool, List[str]]:
+    if use_cache:
+        cached = subscription_cache.get(user_id)
+        if cached is not None:
+            return (cached[0], list(cached[1]))
+    
+    # Одновременные запросы одного пользователя ждут одну общую проверку
+    task = subscription_inflight.get(user_id)
+    if task is None:
+        task = asyncio.create_task(fetch_subscription(user_id, bot))
+        subscription_inflight[user_id] = task
+        task.add_done_callback(lambda _: subscription_inflight.pop(user_id, None))
+    
+    is_subscribed, not_subscribed = await asyncio.shield(task)
+    return (is_subscribed, list(not_subscribed))
+
 def get_subscription_keyboard(not_subscribed: List[str] = None) -> InlineKeyboardMarkup:
     if not_subscribed is None:
         not_subscribed = REQUIRED_CHANNELS
@@ -155,6 +542,413 @@ def get_subscription_keyboard(not_subscribed: List[str] = None) -> InlineKeyboar
     keyboard.append([InlineKeyboardButton("✅ Я подписался", callback_data="check_subscription")])
     return InlineKeyboardMarkup(keyboard)
 
+def get_autostock_keyboard(category: str, user_mask: int) -> InlineKeyboardMarkup:
+    """Клавиатура категории, мемоизированная по маске отслеживаемых предметов"""
+    items_list = SEED_ITEMS_LIST if category == 'seed' else GEAR_ITEMS_LIST
+    key = (category, user_mask & CATEGORY_MASKS.get(category, 0))
+    markup = autostock_keyboard_cache.get(key)
+    if markup is not None:
+        return markup
+    
+    keyboard = []
+    for item_name, item_info in items_list:
+        status = "✅" if user_mask & ITEM_BITS[item_name] else "➕"
+        keyboard.append([InlineKeyboardButton(
+            f"{status} {item_info['emoji']} {item_name} - {item_info['price']}",
+            callback_data=NAME_TO_ID.get(item_name, "invalid")
+        )])
+    keyboard.append([InlineKeyboardButton("⬅️ Назад", callback_data="as_back")])
+    
+    if len(autostock_keyboard_cache) >= KEYBOARD_CACHE_LIMIT:
+        autostock_keyboard_cache.clear()
+    markup = InlineKeyboardMarkup(keyboard)
+    autostock_keyboard_cache[key] = markup
+    return markup
+
+# ========== КУЛДАУНЫ ==========
+class CooldownStore:
+    """Кулдауны на монотонных часах с вытеснением по корзинам (timing wheel).
+    
+    Записи адресуются парой (владелец, слот предмета из ITEM_SLOTS) и удаляются,
+    как только истёк их TTL, поэтому память не растёт со временем работы.
+    """
+    def __init__(self, ttl: float, resolution: float = COOLDOWN_WHEEL_RESOLUTION):
+        self.ttl = ttl
+        self.resolution = resolution
+        self.deadlines: Dict[Hashable, Dict[int, float]] = {}
+        self._wheel: Dict[int, List[Tuple[Hashable, int]]] = {}
+        self._tick = int(time.monotonic() / resolution)
+    
+    def ready(self, owner: Hashable, slot: int, now: Optional[float] = None) -> bool:
+        slots = self.deadlines.get(owner)
+        if slots is None:
+            return True
+        deadline = slots.get(slot)
+        if deadline is None:
+            return True
+        return deadline <= (time.monotonic() if now is None else now)
+    
+    def remaining(self, owner: Hashable, slot: int, now: Optional[float] = None) -> float:
+        deadline = self.deadlines.get(owner, {}).get(slot)
+        if deadline is None:
+            return 0.0
+        return max(0.0, deadline - (time.monotonic() if now is None else now))
+    
+    def mark(self, owner: Hashable, slot: int, now: Optional[float] = None):
+        if now is None:
+            now = time.monotonic()
+        deadline = now + self.ttl
+        self.deadlines.setdefault(owner, {})[slot] = deadline
+        # Корзина гарантированно заканчивается позже дедлайна
+        self._wheel.setdefault(int(deadline / self.resolution) + 1, []).append((owner, slot))
+        self.expire(now)
+    
+    def discard(self, owner: Hashable):
+        self.deadlines.pop(owner, None)
+    
+    def expire(self, now: Optional[float] = None):
+        if now is None:
+            now = time.monotonic()
+        current = int(now / self.resolution)
+        if current <= self._tick:
+            return
+        
+        if current - self._tick > len(self._wheel):
+            ticks = [tick for tick in self._wheel if tick <= current]
+        else:
+            ticks = range(self._tick + 1, current + 1)
+        self._tick = current
+        
+        for tick in ticks:
+            for owner, slot in self._wheel.pop(tick, ()):
+                slots = self.deadlines.get(owner)
+                if not slots:
+                    continue
+                deadline = slots.get(slot)
+                # Перезаписанная позже запись лежит в своей корзине
+                if deadline is not None and deadline <= now:
+                    del slots[slot]
+                    if not slots:
+                        del self.deadlines[owner]
+    
+    def __len__(self) -> int:
+        return len(self.deadlines)
+
+# Персональные кулдауны: владелец — user_id
+user_sent_notifications = CooldownStore(USER_NOTIFICATION_COOLDOWN)
+# Глобальные кулдауны предметов: владелец — область (fan-out или публичный канал)
+item_last_seen = CooldownStore(ITEM_NOTIFY_COOLDOWN)
+ITEM_SCOPE_USERS = "users"
+ITEM_SCOPE_CHANNEL = "channel"
+
+# ========== ДЕДУПЛИКАЦИЯ RESTOCK ==========
+class RestockDeduplicator:
+    """Обработанные restock-сообщения: ID Discord и хэши содержимого, с сохранением на диск.
+    
+    ID ловят повтор того же события после переподключения шлюза, хэш — репост
+    того же стока новым сообщением. Хэш живёт RESTOCK_DUPLICATE_WINDOW секунд,
+    чтобы одинаковый сток в следующем цикле не считался дублем.
+    """
+    def __init__(self, path: str, max_ids: int = RESTOCK_DEDUP_MAX_IDS, window: float = RESTOCK_DUPLICATE_WINDOW):
+        self.path = path
+        self.max_ids = max_ids
+        self.window = window
+        self.message_ids: OrderedDict = OrderedDict()
+        self.digests: Dict[str, float] = {}
+        self._save_lock = asyncio.Lock()
+    
+    @staticmethod
+    def digest(content: str, embeds: List[discord.Embed]) -> str:
+        """Хэш сырого содержимого сообщения — считается до парсинга"""
+        h = hashlib.sha256((content or "").encode('utf-8'))
+        for embed in embeds:
+            for part in (embed.title, embed.description):
+                h.update(b"\x00" + (part or "").encode('utf-8'))
+            for field in embed.fields:
+                h.update(b"\x01" + (field.name or "").encode('utf-8'))
+                h.update(b"\x02" + (field.value or "").encode('utf-8'))
+        return h.hexdigest()
+    
+    def _expire(self, now: float):
+        expired = [digest for digest, seen_at in self.digests.items() if now - seen_at > self.window]
+        for digest in expired:
+            del self.digests[digest]
+    
+    def claim(self, message_id: int, digest: str) -> bool:
+        """Отмечает сообщение обработанным; False — если это дубль"""
+        now = time.time()
+        self._expire(now)
+        if message_id in self.message_ids or digest in self.digests:
+            return False
+        
+        self.message_ids[message_id] = now
+        while len(self.message_ids) > self.max_ids:
+            self.message_ids.popitem(last=False)
+        self.digests[digest] = now
+        return True
+    
+    def load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.warning(f"⚠️ Не удалось прочитать {self.path}: {e}")
+            return
+        
+        for message_id, seen_at in data.get("message_ids", [])[-self.max_ids:]:
+            self.message_ids[int(message_id)] = seen_at
+        self.digests = {digest: seen_at for digest, seen_at in data.get("digests", {}).items()}
+        self._expire(time.time())
+        logger.info(f"🧾 Загружено обработанных restock: {len(self.message_ids)}")
+    
+    async def save(self):
+        data = {"message_ids": list(self.message_ids.items()), "digests": dict(self.digests)}
+        async with self._save_lock:
+            try:
+                await asyncio.to_thread(write_json_atomic, self.path, data)
+            except OSError as e:
+                logger.warning(f"⚠️ Не удалось сохранить {self.path}: {e}")
+
+restock_dedup = RestockDeduplicator(RESTOCK_DEDUP_FILE)
+
+# ========== ИСТОРИЯ СТОКОВ ==========
+def format_duration(seconds: float) -> str:
+    seconds = int(seconds)
+    if seconds < 3600:
+        return f"{seconds // 60}м {seconds % 60}с"
+    if seconds < 86400:
+        return f"{seconds // 3600}ч {seconds % 3600 // 60}м"
+    return f"{seconds // 86400}д {seconds % 86400 // 3600}ч"
+
+class ItemRollup:
+    """Сводка по предмету: обновляется на каждом restock, а не пересчитывается по журналу"""
+    __slots__ = ("appearances", "first_seen", "last_seen", "quantity_total", "quantities")
+    
+    def __init__(self, appearances: int = 0, first_seen: float = 0.0, last_seen: float = 0.0, quantity_total: int = 0):
+        self.appearances = appearances
+        self.first_seen = first_seen
+        self.last_seen = last_seen
+        self.quantity_total = quantity_total
+        self.quantities: Dict[int, int] = {}
+    
+    def add(self, seen_at: float, quantity: int):
+        if not self.appearances:
+            self.first_seen = seen_at
+        self.appearances += 1
+        self.last_seen = seen_at
+        self.quantity_total += quantity
+        self.quantities[quantity] = self.quantities.get(quantity, 0) + 1
+    
+    @property
+    def average_interval(self) -> Optional[float]:
+        if self.appearances < 2:
+            return None
+        return (self.last_seen - self.first_seen) / (self.appearances - 1)
+    
+    @property
+    def average_quantity(self) -> float:
+        return self.quantity_total / self.appearances if self.appearances else 0.0
+
+class RestockHistory:
+    """Журнал restock в SQLite (WAL) и сводки по предметам.
+    
+    Сводки хранятся в отдельных таблицах и обновляются в той же транзакции,
+    что и запись restock; /history читает их копию в памяти, не трогая журнал.
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS restocks (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            message_id INTEGER,
+            seen_at REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS restock_items (
+            restock_id INTEGER NOT NULL REFERENCES restocks(id),
+            item_name TEXT NOT NULL,
+            quantity INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS item_rollups (
+            item_name TEXT PRIMARY KEY,
+            appearances INTEGER NOT NULL,
+            first_seen REAL NOT NULL,
+            last_seen REAL NOT NULL,
+            quantity_total INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS item_quantities (
+            item_name TEXT NOT NULL,
+            quantity INTEGER NOT NULL,
+            seen INTEGER NOT NULL,
+            PRIMARY KEY (item_name, quantity)
+        );
+    """
+    
+    def __init__(self, path: str):
+        self.path = path
+        self.conn: Optional[sqlite3.Connection] = None
+        self.rollups: Dict[str, ItemRollup] = {}
+        self.restocks = 0
+        # Последний записанный restock: (время, [(предмет, количество)]) — для прогрева стока
+        self.latest: Optional[Tuple[float, List[Tuple[str, int]]]] = None
+        self._lock = asyncio.Lock()
+    
+    def _open(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(self.SCHEMA)
+        
+        rollups = {}
+        for name, appearances, first_seen, last_seen, quantity_total in conn.execute(
+            "SELECT item_name, appearances, first_seen, last_seen, quantity_total FROM item_rollups"
+        ):
+            rollups[name] = ItemRollup(appearances, first_seen, last_seen, quantity_total)
+        for name, quantity, seen in conn.execute("SELECT item_name, quantity, seen FROM item_quantities"):
+            if name in rollups:
+                rollups[name].quantities[quantity] = seen
+        
+        self.restocks = conn.execute("SELECT COUNT(*) FROM restocks").fetchone()[0]
+        last = conn.execute("SELECT id, seen_at FROM restocks ORDER BY id DESC LIMIT 1").fetchone()
+        if last:
+            items = conn.execute("SELECT item_name, quantity FROM restock_items WHERE restock_id = ?", (last[0],)).fetchall()
+            self.latest = (last[1], items)
+        self.rollups = rollups
+        self.conn = conn
+    
+    def latest_stock(self) -> Optional[Tuple[datetime, Dict]]:
+        """Последний записанный сток в формате parse_stock_message"""
+        if not self.latest:
+            return None
+        seen_at, items = self.latest
+        stock_data = {"seeds": [], "gear": []}
+        for item_name, quantity in items:
+            if item_name in ITEMS_DATA:
+                stock_data[STOCK_KEYS[ITEMS_DATA[item_name]['category']]].append((item_name, quantity))
+        return datetime.fromtimestamp(seen_at, pytz.timezone('Europe/Moscow')), stock_data
+    
+    async def open(self):
+        try:
+            await asyncio.to_thread(self._open)
+            logger.info(f"🗄️ История стоков: {self.restocks} restock, {len(self.rollups)} предметов")
+        except sqlite3.Error as e:
+            logger.error(f"❌ Не удалось открыть историю стоков {self.path}: {e}")
+    
+    def _write(self, message_id: Optional[int], seen_at: float, items: List[Tuple[str, int]]):
+        with self.conn:
+            cursor = self.conn.execute("INSERT INTO restocks (message_id, seen_at) VALUES (?, ?)", (message_id, seen_at))
+            restock_id = cursor.lastrowid
+            self.conn.executemany(
+                "INSERT INTO restock_items (restock_id, item_name, quantity) VALUES (?, ?, ?)",
+                [(restock_id, name, quantity) for name, quantity in items]
+            )
+            self.conn.executemany(
+                "INSERT INTO item_rollups (item_name, appearances, first_seen, last_seen, quantity_total) "
+                "VALUES (?, 1, ?, ?, ?) ON CONFLICT(item_name) DO UPDATE SET "
+                "appearances = appearances + 1, last_seen = excluded.last_seen, "
+                "quantity_total = quantity_total + excluded.quantity_total",
+                [(name, seen_at, seen_at, quantity) for name, quantity in items]
+            )
+            self.conn.executemany(
+                "INSERT INTO item_quantities (item_name, quantity, seen) VALUES (?, ?, 1) "
+                "ON CONFLICT(item_name, quantity) DO UPDATE SET seen = seen + 1",
+                [(name, quantity) for name, quantity in items]
+            )
+    
+    async def record(self, stock_data: Dict, message_id: Optional[int] = None):
+        """Дописывает restock в журнал и обновляет сводки"""
+        if self.conn is None:
+            return
+        
+        items = stock_data.get('seeds', []) + stock_data.get('gear', [])
+        seen_at = time.time()
+        async with self._lock:
+            try:
+                await asyncio.to_thread(self._write, message_id, seen_at, items)
+            except sqlite3.Error as e:
+                logger.error(f"❌ Ошибка записи истории стоков: {e}")
+                return
+            
+            # Копия в памяти меняется только после успешного коммита
+            self.restocks += 1
+            self.latest = (seen_at, items)
+            for name, quantity in items:
+                self.rollups.setdefault(name, ItemRollup()).add(seen_at, quantity)
+    
+    async def close(self):
+        if self.conn is None:
+            return
+        async with self._lock:
+            await asyncio.to_thread(self.conn.close)
+            self.conn = None
+
+restock_history = RestockHistory(RESTOCK_HISTORY_DB)
+
+# ========== ИНДЕКС ПОДПИСЧИКОВ ==========
+class SubscriberIndex:
+    """Инвертированный индекс предмет → пользователи для fan-out без запросов к БД"""
+    def __init__(self):
+        self.items: Dict[str, Set[int]] = {}
+        self.loaded = False
+        self.loaded_at: Optional[datetime] = None
+        # Изменения, пришедшие во время перезагрузки, накатываются поверх снимка
+        self._journal: Optional[List[Tuple[str, int, Optional[str]]]] = None
+    
+    def add(self, user_id: int, item_name: str):
+        self.items.setdefault(item_name, set()).add(user_id)
+        if self._journal is not None:
+            self._journal.append(("add", user_id, item_name))
+    
+    def remove(self, user_id: int, item_name: str):
+        users = self.items.get(item_name)
+        if users:
+            users.discard(user_id)
+        if self._journal is not None:
+            self._journal.append(("remove", user_id, item_name))
+    
+    def remove_user(self, user_id: int):
+        for users in self.items.values():
+            users.discard(user_id)
+        if self._journal is not None:
+            self._journal.append(("remove_user", user_id, None))
+    
+    def set_user_items(self, user_id: int, mask: int):
+        """Синхронизирует индекс с актуальной маской предметов пользователя"""
+        for item_name, bit in ITEM_BITS.items():
+            if mask & bit:
+                self.add(user_id, item_name)
+            else:
+                self.remove(user_id, item_name)
+    
+    def users_for(self, item_name: str) -> Tuple[int, ...]:
+        return tuple(self.items.get(item_name, ()))
+    
+    def begin_reload(self):
+        self._journal = []
+    
+    def finish_reload(self, snapshot: Optional[Dict[str, Set[int]]]) -> bool:
+        journal, self._journal = self._journal or [], None
+        if snapshot is None:
+            return False
+        
+        for action, user_id, item_name in journal:
+            if action == "add":
+                snapshot.setdefault(item_name, set()).add(user_id)
+            elif action == "remove":
+                snapshot.get(item_name, set()).discard(user_id)
+            else:
+                for users in snapshot.values():
+                    users.discard(user_id)
+        
+        self.items = snapshot
+        self.loaded = True
+        self.loaded_at = get_moscow_time()
+        return True
+    
+    def __len__(self) -> int:
+        return sum(len(users) for users in self.items.values())
+
+subscriber_index = SubscriberIndex()
+
 # ========== БАЗА ДАННЫХ ==========
 class SupabaseDB:
     def __init__(self):
@@ -163,6 +957,14 @@ class SupabaseDB:
             "Authorization": f"Bearer {SUPABASE_API_KEY}",
             "Content-Type": "application/json"
         }
+        # Write-behind буфер upsert'ов bot_users: user_id → последняя строка
+        self.pending_users: Dict[int, Dict] = {}
+        self._users_flush_lock = asyncio.Lock()
+        self._users_flush_task: Optional[asyncio.Task] = None
+        # Отложенные переключения автостоков: user_id → item → (состояние в БД, желаемое)
+        self.pending_toggles: Dict[int, Dict[str, Tuple[bool, bool]]] = {}
+        self._toggle_tasks: Dict[int, asyncio.Task] = {}
+        self._toggle_rejections: Dict[int, int] = {}
     
     async def get_session(self) -> aiohttp.ClientSession:
         global http_session
@@ -172,75 +974,137 @@ class SupabaseDB:
             http_session = aiohttp.ClientSession(connector=connector, timeout=timeout)
         return http_session
     
-    async def save_user(self, user_id: int, username: str = None, first_name: str = None):
-        try:
-            session = await self.get_session()
-            data = {
-                "user_id": user_id,
-                "username": username,
-                "first_name": first_name,
-                "last_seen": get_moscow_time().isoformat()
-            }
-            headers = {**self.headers, "Prefer": "resolution=merge-duplicates"}
-            async with session.post(USERS_URL, json=data, headers=headers, timeout=5) as response:
-                return response.status in [200, 201]
-        except Exception as e:
-            logger.error(f"❌ save_user: {e}")
+    def queue_user(self, user_id: int, username: str = None, first_name: str = None):
+        """Ставит upsert пользователя в буфер; повторные вызовы перезаписывают last_seen"""
+        self.pending_users[user_id] = {
+            "user_id": user_id,
+            "username": username,
+            "first_name": first_name,
+            "last_seen": get_moscow_time().isoformat()
+        }
+        if len(self.pending_users) >= USERS_FLUSH_BATCH:
+            if self._users_flush_task is None or self._users_flush_task.done():
+                self._users_flush_task = asyncio.create_task(self.flush_users())
+    
+    async def flush_users(self) -> bool:
+        """Отправляет накопленных пользователей одним bulk upsert"""
+        async with self._users_flush_lock:
+            if not self.pending_users:
+                return True
+            
+            batch, self.pending_users = self.pending_users, {}
+            try:
+                session = await self.get_session()
+                headers = {**self.headers, "Prefer": "resolution=merge-duplicates,return=minimal"}
+                async with session.post(USERS_URL, json=list(batch.values()), headers=headers, timeout=15) as response:
+                    if response.status in [200, 201, 204]:
+                        logger.debug(f"💾 bot_users: сохранено {len(batch)}")
+                        return True
+                    logger.error(f"❌ flush_users: HTTP {response.status}")
+            except Exception as e:
+                logger.error(f"❌ flush_users: {e}")
+            
+            # Возвращаем в буфер, не затирая более свежие записи
+            for user_id, row in batch.items():
+                self.pending_users.setdefault(user_id, row)
             return False
     
+    async def iter_pages(self, url: str, params: Dict, keys: Tuple[str, ...] = ("user_id",),
+                         page_size: int = DB_PAGE_SIZE, after: Optional[Tuple] = None) -> AsyncIterator[List[Dict]]:
+        """Keyset-пагинация (key > последний ключ) с предзагрузкой следующей страницы.
+        
+        В отличие от offset, каждая страница — поиск по индексу, а не пропуск уже
+        прочитанных строк. keys должны однозначно упорядочивать строки;
+        after — ключ, с которого продолжить.
+        """
+        session = await self.get_session()
+        
+        async def fetch(after: Optional[Tuple]) -> List[Dict]:
+            page_params = {**params, "order": ",".join(f"{key}.asc" for key in keys), "limit": page_size}
+            if after is not None:
+                if len(keys) == 1:
+                    page_params[keys[0]] = f"gt.{after[0]}"
+                else:
+                    # (user_id, item_name) > (a, b) в синтаксисе PostgREST
+                    first, second = keys
+                    page_params["or"] = (
+                        f'({first}.gt.{after[0]},and({first}.eq.{after[0]},{second}.gt."{after[1]}"))'
+                    )
+            async with session.get(url, headers=self.headers, params=page_params, timeout=30) as response:
+                if response.status != 200:
+                    raise RuntimeError(f"HTTP {response.status}")
+                return await response.json()
+        
+        next_page = asyncio.create_task(fetch(after))
+        try:
+            while next_page is not None:
+                page = await next_page
+                next_page = None
+                if len(page) == page_size:
+                    # Следующая страница грузится, пока вызывающий обрабатывает текущую
+                    next_page = asyncio.create_task(fetch(tuple(page[-1][key] for key in keys)))
+                if page:
+                    yield page
+        finally:
+            if next_page is not None:
+                next_page.cancel()
+    
+    async def iter_users(self, after: Optional[int] = None) -> AsyncIterator[int]:
+        start = (after,) if after is not None else None
+        async for page in self.iter_pages(USERS_URL, {"select": "user_id"}, after=start):
+            for item in page:
+                yield item['user_id']
+    
+    async def iter_users_tracking_item(self, item_name: str) -> AsyncIterator[int]:
+        params = {"item_name": f"eq.{item_name}", "select": "user_id"}
+        async for page in self.iter_pages(AUTOSTOCKS_URL, params):
+            for item in page:
+                yield item['user_id']
+    
     async def get_all_users(self) -> List[int]:
         all_users = []
-        offset = 0
-        limit = 1000
-        
         try:
-            session = await self.get_session()
-            while True:
-                params = {"select": "user_id", "limit": limit, "offset": offset, "order": "user_id.asc"}
-                async with session.get(USERS_URL, headers=self.headers, params=params, timeout=15) as response:
-                    if response.status == 200:
-                        data = await response.json()
-                        if not data:
-                            break
-                        all_users.extend([item['user_id'] for item in data])
-                        if len(data) < limit:
-                            break
-                        offset += limit
-                        await asyncio.sleep(0.1)
-                    else:
-                        break
+            async for user_id in self.iter_users():
+                all_users.append(user_id)
             return all_users
         except Exception as e:
             logger.error(f"❌ get_all_users: {e}")
             return all_users
     
-    async def delete_user(self, user_id: int) -> bool:
+    async def get_recent_users(self, limit: int) -> List[int]:
+        """Последние активные пользователи — для прогрева кэша подписок"""
         try:
             session = await self.get_session()
-            params = {"user_id": f"eq.{user_id}"}
-            async with session.delete(USERS_URL, headers=self.headers, params=params, timeout=5) as response:
-                return response.status in [200, 204]
+            params = {"select": "user_id", "order": "last_seen.desc.nullslast", "limit": limit}
+            async with session.get(USERS_URL, headers=self.headers, params=params, timeout=15) as response:
+                if response.status != 200:
+                    return []
+                data = await response.json()
+                return [item['user_id'] for item in data]
         except Exception as e:
-            logger.error(f"❌ delete_user: {e}")
-            return False
+            logger.error(f"❌ get_recent_users: {e}")
+            return []
     
-    async def delete_user_autostocks(self, user_id: int) -> bool:
+    async def delete_users(self, user_ids: List[int]) -> bool:
+        """Удаляет пользователей вместе с автостоками: по одному запросу на таблицу"""
         try:
             session = await self.get_session()
-            params = {"user_id": f"eq.{user_id}"}
-            async with session.delete(AUTOSTOCKS_URL, headers=self.headers, params=params, timeout=5) as response:
-                return response.status in [200, 204]
+            params = {"user_id": f"in.({','.join(str(user_id) for user_id in user_ids)})"}
+            deleted = True
+            for url in (AUTOSTOCKS_URL, USERS_URL):
+                async with session.delete(url, headers=self.headers, params=params, timeout=15) as response:
+                    deleted = deleted and response.status in [200, 204]
+            return deleted
         except Exception as e:
-            logger.error(f"❌ delete_autostocks: {e}")
+            logger.error(f"❌ delete_users: {e}")
             return False
     
-    async def load_user_autostocks(self, user_id: int, use_cache: bool = True) -> Set[str]:
-        if use_cache and user_id in user_autostocks_cache:
-            cache_time = user_autostocks_time.get(user_id)
-            if cache_time:
-                now = get_moscow_time()
-                if (now - cache_time).total_seconds() < AUTOSTOCK_CACHE_TTL:
-                    return user_autostocks_cache[user_id].copy()
+    async def load_user_autostocks(self, user_id: int, use_cache: bool = True) -> int:
+        """Битовая маска отслеживаемых предметов (биты из ITEM_BITS)"""
+        if use_cache:
+            cached = user_autostocks_cache.get(user_id)
+            if cached is not None:
+                return cached
         
         try:
             session = await self.get_session()
@@ -248,74 +1112,376 @@ class SupabaseDB:
             async with session.get(AUTOSTOCKS_URL, headers=self.headers, params=params, timeout=5) as response:
                 if response.status == 200:
                     data = await response.json()
-                    items_set = {item['item_name'] for item in data}
-                    user_autostocks_cache[user_id] = items_set
-                    user_autostocks_time[user_id] = get_moscow_time()
-                    return items_set
-                return set()
+                    mask = items_to_mask(item['item_name'] for item in data)
+                    # Несохранённые переключения важнее ответа БД
+                    for item_name, (_, tracking) in self.pending_toggles.get(user_id, {}).items():
+                        if tracking:
+                            mask |= ITEM_BITS[item_name]
+                        else:
+                            mask &= ~ITEM_BITS[item_name]
+                    user_autostocks_cache.set(user_id, mask)
+                    subscriber_index.set_user_items(user_id, mask)
+                    return mask
+                return 0
         except Exception as e:
             logger.error(f"❌ load_autostocks: {e}")
-            return set()
+            return 0
     
-    async def save_user_autostock(self, user_id: int, item_name: str) -> bool:
-        if user_id not in user_autostocks_cache:
-            user_autostocks_cache[user_id] = set()
-        user_autostocks_cache[user_id].add(item_name)
-        user_autostocks_time[user_id] = get_moscow_time()
+    def set_user_autostock(self, user_id: int, item_name: str, tracking: bool):
+        """Сразу меняет кэш и индекс, а запись в БД откладывает на окно дебаунса"""
+        bit = ITEM_BITS[item_name]
+        mask = user_autostocks_cache.peek(user_id)
+        # Без кэша считаем, что переключение меняет текущее состояние на противоположное
+        was_tracking = bool(mask & bit) if mask is not None else not tracking
+        if tracking:
+            subscriber_index.add(user_id, item_name)
+        else:
+            subscriber_index.remove(user_id, item_name)
+        if mask is not None:
+            user_autostocks_cache.set(user_id, mask | bit if tracking else mask & ~bit)
         
-        try:
-            session = await self.get_session()
-            data = {"user_id": user_id, "item_name": item_name}
-            async with session.post(AUTOSTOCKS_URL, json=data, headers=self.headers, timeout=5) as response:
-                return response.status in [200, 201]
-        except Exception as e:
-            logger.error(f"❌ save_autostock: {e}")
-            return False
+        toggles = self.pending_toggles.setdefault(user_id, {})
+        persisted = toggles[item_name][0] if item_name in toggles else was_tracking
+        toggles[item_name] = (persisted, tracking)
+        self._schedule_toggle_flush(user_id)
+    
+    def _schedule_toggle_flush(self, user_id: int):
+        if user_id not in self._toggle_tasks:
+            self._toggle_tasks[user_id] = asyncio.create_task(self._flush_toggles_later(user_id))
+    
+    async def _flush_toggles_later(self, user_id: int):
+        await asyncio.sleep(AUTOSTOCK_TOGGLE_DEBOUNCE_SECONDS)
+        self._toggle_tasks.pop(user_id, None)
+        await self.flush_user_toggles(user_id)
     
-    async def remove_user_autostock(self, user_id: int, item_name: str) -> bool:
-        if user_id in user_autostocks_cache:
-            user_autostocks_cache[user_id].discard(item_name)
-            user_autostocks_time[user_id] = get_moscow_time()
+    async def flush_user_toggles(self, user_id: int, retry: bool = True) -> bool:
+        """Записывает итог переключений одним bulk insert и одним bulk delete.
         
-        try:
-            session = await self.get_session()
-            params = {"user_id": f"eq.{user_id}", "item_name": f"eq.{item_name}"}
-            async with session.delete(AUTOSTOCKS_URL, headers=self.headers, params=params, timeout=5) as response:
-                return response.status in [200, 204]
-        except Exception as e:
-            logger.error(f"❌ remove_autostock: {e}")
-            return False
+        Переключения остаются в pending_toggles, пока запись не подтверждена:
+        load_user_autostocks накладывает их поверх ответа БД.
+        """
+        toggles = dict(self.pending_toggles.get(user_id, {}))
+        if not toggles:
+            self._toggle_rejections.pop(user_id, None)
+            return True
+        
+        to_add = [name for name, (persisted, tracking) in toggles.items() if tracking and not persisted]
+        to_remove = [name for name, (persisted, tracking) in toggles.items() if persisted and not tracking]
+        written: List[str] = []
+        # 4xx не пройдёт и при повторе — такие ответы считаются отдельно
+        rejected = False
+        
+        if to_add:
+            try:
+                session = await self.get_session()
+                data = [{"user_id": user_id, "item_name": name} for name in to_add]
+                # Строка уже есть в БД (повтор после таймаута) — не 409, а тихий пропуск
+                headers = {**self.headers, "Prefer": "resolution=ignore-duplicates"}
+                async with session.post(AUTOSTOCKS_URL, json=data, headers=headers, timeout=5) as response:
+                    if response.status in [200, 201]:
+                        written.extend(to_add)
+                    else:
+                        logger.error(f"❌ flush_toggles (insert): HTTP {response.status}")
+                        rejected = rejected or 400 <= response.status < 500
+            except Exception as e:
+                logger.error(f"❌ flush_toggles (insert): {e}")
+        
+        if to_remove:
+            try:
+                session = await self.get_session()
+                names = ",".join(f'"{name}"' for name in to_remove)
+                params = {"user_id": f"eq.{user_id}", "item_name": f"in.({names})"}
+                async with session.delete(AUTOSTOCKS_URL, headers=self.headers, params=params, timeout=5) as response:
+                    if response.status in [200, 204]:
+                        written.extend(to_remove)
+                    else:
+                        logger.error(f"❌ flush_toggles (delete): HTTP {response.status}")
+                        rejected = rejected or 400 <= response.status < 500
+            except Exception as e:
+                logger.error(f"❌ flush_toggles (delete): {e}")
+        
+        # Снимаем из оверлея записанное и то, что вернулось в исходное состояние без записи.
+        # Если за время записи предмет переключили снова, запоминаем новое состояние БД
+        pending = self.pending_toggles.get(user_id, {})
+        for item_name in written:
+            if item_name in pending:
+                persisted, tracking = toggles[item_name][1], pending[item_name][1]
+                if persisted == tracking:
+                    del pending[item_name]
+                else:
+                    pending[item_name] = (persisted, tracking)
+        for item_name, (persisted, tracking) in toggles.items():
+            if persisted == tracking and pending.get(item_name) == (persisted, tracking):
+                del pending[item_name]
+        if not pending:
+            self.pending_toggles.pop(user_id, None)
+        
+        if len(written) == len(to_add) + len(to_remove):
+            self._toggle_rejections.pop(user_id, None)
+            return True
+        
+        if rejected:
+            rejections = self._toggle_rejections.get(user_id, 0) + 1
+            if rejections >= AUTOSTOCK_TOGGLE_MAX_REJECTIONS:
+                logger.error(f"❌ flush_toggles: Supabase отклоняет запись user {user_id}, переключения отброшены")
+                self._toggle_rejections.pop(user_id, None)
+                self.pending_toggles.pop(user_id, None)
+                # Кэш и индекс возвращаются к состоянию БД
+                await self.load_user_autostocks(user_id, use_cache=False)
+                return False
+            self._toggle_rejections[user_id] = rejections
+        
+        if retry:
+            self._schedule_toggle_flush(user_id)
+        return False
+    
+    async def flush_all_toggles(self):
+        """Сбрасывает все отложенные переключения (при остановке)"""
+        for task in self._toggle_tasks.values():
+            task.cancel()
+        self._toggle_tasks.clear()
+        for user_id in list(self.pending_toggles):
+            await self.flush_user_toggles(user_id, retry=False)
     
     async def get_users_tracking_item(self, item_name: str) -> List[int]:
         all_users = []
-        offset = 0
-        limit = 1000
-        
         try:
-            session = await self.get_session()
-            while True:
-                params = {
-                    "item_name": f"eq.{item_name}",
-                    "select": "user_id",
-                    "limit": limit,
-                    "offset": offset
-                }
-                async with session.get(AUTOSTOCKS_URL, headers=self.headers, params=params, timeout=15) as response:
-                    if response.status == 200:
-                        data = await response.json()
-                        if not data:
-                            break
-                        all_users.extend([item['user_id'] for item in data])
-                        if len(data) < limit:
-                            break
-                        offset += limit
-                        await asyncio.sleep(0.05)
-                    else:
-                        break
+            async for user_id in self.iter_users_tracking_item(item_name):
+                all_users.append(user_id)
             return all_users
         except Exception as e:
             logger.error(f"❌ get_users_tracking: {e}")
             return all_users
+    
+    async def load_subscriber_index(self) -> Optional[Dict[str, Set[int]]]:
+        """Загружает все автостоки одним проходом для индекса подписчиков"""
+        index: Dict[str, Set[int]] = {}
+        try:
+            params = {"select": "user_id,item_name"}
+            async for page in self.iter_pages(AUTOSTOCKS_URL, params, keys=("user_id", "item_name")):
+                for row in page:
+                    index.setdefault(row['item_name'], set()).add(row['user_id'])
+            return index
+        except Exception as e:
+            logger.error(f"❌ load_subscriber_index: {e}")
+            return None
+    
+    def toggle_overlay(self) -> Dict[int, Dict[str, bool]]:
+        """Желаемое состояние по ещё не записанным в БД переключениям"""
+        return {
+            user_id: {item_name: tracking for item_name, (_, tracking) in toggles.items()}
+            for user_id, toggles in self.pending_toggles.items()
+        }
+    
+    async def reload_subscriber_index(self) -> bool:
+        previous = len(subscriber_index)
+        subscriber_index.begin_reload()
+        # Переключения в дебаунсе или в повторе после 5xx снимок БД не увидит.
+        # Берём их и до, и после загрузки: запись могла завершиться, пока шёл снимок
+        overlay = self.toggle_overlay()
+        snapshot = await self.load_subscriber_index()
+        if snapshot is not None:
+            for user_id, toggles in self.toggle_overlay().items():
+                overlay.setdefault(user_id, {}).update(toggles)
+            for user_id, toggles in overlay.items():
+                for item_name, tracking in toggles.items():
+                    if tracking:
+                        snapshot.setdefault(item_name, set()).add(user_id)
+                    else:
+                        snapshot.get(item_name, set()).discard(user_id)
+        if not subscriber_index.finish_reload(snapshot):
+            return False
+        logger.info(f"🗂️ Индекс подписчиков: {len(subscriber_index)} подписок (было {previous})")
+        return True
+
+# ========== ОТПРАВКА УВЕДОМЛЕНИЙ ==========
+def retry_after_seconds(error: RetryAfter) -> float:
+    retry_after = error.retry_after
+    if isinstance(retry_after, timedelta):
+        return retry_after.total_seconds()
+    return float(retry_after)
+
+def is_blocked_error(error: TelegramError) -> bool:
+    """Пользователь заблокировал бота или удалил аккаунт"""
+    error_msg = str(error).lower()
+    return "forbidden" in error_msg or "blocked" in error_msg or "user is deactivated" in error_msg
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 1
+PRIORITY_BACKGROUND = 2
+
+class TokenBucket:
+    """Token bucket под глобальный лимит Telegram с полосами приоритета.
+    
+    Внутри полосы токены выдаются по очереди. Полоса уступает токен, пока кто-то
+    ждёт в более приоритетной: ответы пользователям, затем уведомления, затем рассылка.
+    
+    shared_pause — multiprocessing.Value с моментом окончания паузы, общий для
+    процессов fan-out: RetryAfter в одном останавливает все.
+    """
+    def __init__(self, rate: float, capacity: float, shared_pause=None):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.shared_pause = shared_pause
+        self._lanes = {priority: asyncio.Lock() for priority in (PRIORITY_INTERACTIVE, PRIORITY_BULK, PRIORITY_BACKGROUND)}
+        self.waiting = {priority: 0 for priority in self._lanes}
+    
+    def _pause_end(self) -> float:
+        if self.shared_pause is None:
+            return self.paused_until
+        # time.monotonic() общий для процессов одной машины
+        return max(self.paused_until, self.shared_pause.value)
+    
+    def _refill(self, now: float, paused_until: float):
+        # Во время паузы после RetryAfter токены не накапливаются
+        start = max(self.updated, paused_until)
+        if now > start:
+            self.tokens = min(self.capacity, self.tokens + (now - start) * self.rate)
+        self.updated = now
+    
+    def set_rate(self, rate: float):
+        """Меняет лимит на лету; накопленные по старому лимиту токены сохраняются в пределах нового"""
+        self._refill(time.monotonic(), self._pause_end())
+        self.rate = self.capacity = rate
+        self.tokens = min(self.tokens, self.capacity)
+    
+    def pause(self, seconds: float):
+        """Останавливает выдачу токенов на время, указанное Telegram"""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+        if self.shared_pause is not None:
+            with self.shared_pause.get_lock():
+                self.shared_pause.value = max(self.shared_pause.value, self.paused_until)
+    
+    async def acquire(self, priority: int = PRIORITY_BULK):
+        self.waiting[priority] += 1
+        try:
+            async with self._lanes[priority]:
+                while True:
+                    now = time.monotonic()
+                    paused_until = self._pause_end()
+                    self._refill(now, paused_until)
+                    if now < paused_until:
+                        # Пауза могла прийти из другого процесса: накопленные токены тоже сгорают
+                        self.tokens = 0
+                        await asyncio.sleep(paused_until - now)
+                    elif any(self.waiting[lane] for lane in range(priority)):
+                        await asyncio.sleep(1 / self.rate)
+                    elif self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    else:
+                        await asyncio.sleep((1 - self.tokens) / self.rate)
+        finally:
+            self.waiting[priority] -= 1
+
+class NotificationDispatcher:
+    """Единая очередь исходящих отправок: token bucket, backpressure и повтор после RetryAfter.
+    
+    Задача — корутина-функция, делающая ровно один вызов Telegram API
+    и пробрасывающая RetryAfter наружу. Несколько диспетчеров могут делить
+    один bucket, каждый в своей полосе приоритета.
+    """
+    def __init__(self, rate: float, queue_size: int, workers: int,
+                 bucket: Optional[TokenBucket] = None, priority: int = PRIORITY_BULK):
+        self.bucket = bucket or TokenBucket(rate, rate)
+        self.priority = priority
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self.workers_count = workers
+        self.workers: List[asyncio.Task] = []
+        self.sent = 0
+        self.retries = 0
+    
+    def _ensure_workers(self):
+        if not self.workers:
+            self.workers = [asyncio.create_task(self._worker()) for _ in range(self.workers_count)]
+    
+    async def submit(self, func, *args) -> asyncio.Future:
+        """Ставит задачу в очередь; при заполненной очереди ждёт освобождения места"""
+        self._ensure_workers()
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((func, args, future))
+        return future
+    
+    async def run(self, func, *args):
+        return await (await self.submit(func, *args))
+    
+    async def _worker(self):
+        while True:
+            func, args, future = await self.queue.get()
+            try:
+                if future.done():
+                    continue
+                result = await self._execute(func, args)
+                if not future.done():
+                    future.set_result(result)
+            except asyncio.CancelledError:
+                future.cancel()
+                raise
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+            finally:
+                self.queue.task_done()
+    
+    async def _execute(self, func, args):
+        for attempt in range(1, DISPATCH_MAX_RETRIES + 1):
+            await self.bucket.acquire(self.priority)
+            started = time.perf_counter()
+            try:
+                result = await func(*args)
+                self.sent += 1
+                return result
+            except RetryAfter as e:
+                metrics.retry_after.inc()
+                if attempt == DISPATCH_MAX_RETRIES:
+                    raise
+                delay = retry_after_seconds(e)
+                self.retries += 1
+                logger.warning(f"⏳ Telegram RetryAfter: пауза {delay:.0f}s (попытка {attempt})")
+                self.bucket.pause(delay)
+            finally:
+                metrics.send_seconds.observe(time.perf_counter() - started)
+    
+    async def stop(self):
+        for task in self.workers:
+            task.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+        while not self.queue.empty():
+            _, _, future = self.queue.get_nowait()
+            future.cancel()
+
+notification_dispatcher = NotificationDispatcher(TELEGRAM_GLOBAL_RATE, DISPATCH_QUEUE_SIZE, DISPATCH_WORKERS)
+# Рассылка админа: тот же лимит, но своя очередь и самая низкая полоса — уступает стоку и командам
+broadcast_dispatcher = NotificationDispatcher(
+    TELEGRAM_GLOBAL_RATE, BROADCAST_QUEUE_SIZE, BROADCAST_WORKERS,
+    bucket=notification_dispatcher.bucket, priority=PRIORITY_BACKGROUND
+)
+
+# Методы, которые Telegram считает отправкой сообщений в общий лимит
+RATE_LIMITED_METHODS = ("send", "edit", "copy", "forward")
+
+class InteractiveRateLimiter(BaseRateLimiter):
+    """Ответы на команды и кнопки берут токены общего bucket'а в интерактивной полосе"""
+    async def initialize(self):
+        pass
+    
+    async def shutdown(self):
+        pass
+    
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        bucket = notification_dispatcher.bucket
+        if endpoint.startswith(RATE_LIMITED_METHODS):
+            await bucket.acquire(PRIORITY_INTERACTIVE)
+        try:
+            return await callback(*args, **kwargs)
+        except RetryAfter as e:
+            bucket.pause(retry_after_seconds(e))
+            raise
 
 # ========== DISCORD ПАРСЕР ==========
 class DiscordStockParser:
@@ -343,24 +1509,20 @@ class DiscordStockParser:
                 # field.name = "<:Sunflower:1426493232933634080> Sunflower"
                 # field.value = "+2 stock (<@&1408040455949647943>)"
                 
-                # Извлекаем название предмета из field.name
-                # Убираем кастомные эмодзи формата <:Name:ID>
-                name_clean = re.sub(r'<:[^:]+:\d+>\s*', '', field.name).strip()
-                
                 # Извлекаем количество из field.value
-                value_match = re.search(r'\+(\d+)\s+stock', field.value, re.IGNORECASE)
+                value_match = STOCK_VALUE_RE.search(field.value)
                 
                 if not value_match:
                     continue
                 
                 quantity = int(value_match.group(1))
                 
-                # Нормализуем название
-                item_name = self.normalize_item_name(name_clean)
+                # Название без кастомных эмодзи <:Name:ID>, нормализованное по таблице
+                name_clean, item_name = item_resolver.resolve_field(field.name)
                 
                 if item_name:
                     category = ITEMS_DATA[item_name]['category']
-                    result[f"{category}s"].append((item_name, quantity))
+                    result[STOCK_KEYS[category]].append((item_name, quantity))
                     logger.info(f"✅ Найден: {item_name} x{quantity} ({category})")
                 else:
                     logger.warning(f"⚠️ Не распознан предмет: '{name_clean}' из field.name: '{field.name}'")
@@ -370,93 +1532,38 @@ class DiscordStockParser:
     
     def normalize_item_name(self, raw_name: str) -> Optional[str]:
         """Нормализует название предмета"""
-        raw_name = raw_name.strip().lower()
-        
-        # Убираем лишние слова и символы
-        raw_name = re.sub(r'\s*(seed|gun|launcher|grenade|bucket|blower)\s*', '', raw_name, flags=re.IGNORECASE)
-        raw_name = raw_name.strip()
-        
-        # Прямое сопоставление
-        for item_name in ITEMS_DATA.keys():
-            if item_name.lower() == raw_name:
-                return item_name
-        
-        # Маппинг вариаций
-        name_map = {
-            'dragon': 'Dragon Fruit',
-            'dragon fruit': 'Dragon Fruit',
-            'coco': 'Cocotank',
-            'cocotank': 'Cocotank',
-            'carnivorous': 'Carnivorous Plant',
-            'carnivorous plant': 'Carnivorous Plant',
-            'mr carrot': 'Mr Carrot',
-            'carrot': 'Mr Carrot',
-            'tomatrio': 'Tomatrio',
-            'tomato': 'Tomatrio',
-            'shroombino': 'Shroombino',
-            'mushroom': 'Shroombino',
-            'mango': 'Mango',
-            'limone': 'King Limone',
-            'king limone': 'King Limone',
-            'king lemon': 'King Limone',
-            'lemon': 'King Limone',
-            'starfruit': 'Starfruit',
-            'star': 'Starfruit',
-            'brussel sprouts': 'Brussel Sprouts',
-            'brussel': 'Brussel Sprouts',
-            'sprouts': 'Brussel Sprouts',
-            'kiwi': 'Kiwi Cannoneer',
-            'kiwi cannoneer': 'Kiwi Cannoneer',
-            'cannoneer': 'Kiwi Cannoneer',
-            'water': 'Water Bucket',
-            'water bucket': 'Water Bucket',
-            'bucket': 'Water Bucket',
-            'frost': 'Frost Grenade',
-            'frost grenade': 'Frost Grenade',
-            'banana': 'Banana Gun',
-            'banana gun': 'Banana Gun',
-            'frost blower': 'Frost Blower',
-            'blower': 'Frost Blower',
-            'carrot launcher': 'Carrot Launcher',
-            'launcher': 'Carrot Launcher',
-            'sunflower': 'Sunflower',
-            'pumpkin': 'Pumpkin',
-            'strawberry': 'Strawberry',
-            'cactus': 'Cactus',
-            'eggplant': 'Eggplant',
-            'watermelon': 'Watermelon',
-            'grape': 'Grape'
-        }
-        
-        return name_map.get(raw_name)
+        return item_resolver.resolve(raw_name)
     
-    def format_stock_message(self, stock_data: Dict) -> str:
-        if not stock_data:
-            return "❌ *Не удалось получить данные*"
-        
-        message = "📊 *ТЕКУЩИЙ СТОК*\n\n"
+    def render_stock_body(self, stock_data: Dict) -> str:
+        """Текст стока без строки времени"""
+        lines = ["📊 *ТЕКУЩИЙ СТОК*", "", "🌱 *СЕМЕНА:*"]
         
         # Семена
         seeds = stock_data.get('seeds', [])
-        message += "🌱 *СЕМЕНА:*\n"
         if seeds:
             for item_name, quantity in seeds:
                 item_info = ITEMS_DATA.get(item_name, {"emoji": "📦", "price": "?"})
-                message += f"{item_info['emoji']} *{item_name}*: x{quantity} ({item_info['price']})\n"
+                lines.append(f"{item_info['emoji']} *{item_name}*: x{quantity} ({item_info['price']})")
         else:
-            message += "_Пусто_\n"
+            lines.append("_Пусто_")
         
         # Снаряжение
         gear = stock_data.get('gear', [])
         if gear:
-            message += "\n⚔️ *СНАРЯЖЕНИЕ:*\n"
+            lines.extend(["", "⚔️ *СНАРЯЖЕНИЕ:*"])
             for item_name, quantity in gear:
                 item_info = ITEMS_DATA.get(item_name, {"emoji": "📦", "price": "?"})
-                message += f"{item_info['emoji']} *{item_name}*: x{quantity} ({item_info['price']})\n"
+                lines.append(f"{item_info['emoji']} *{item_name}*: x{quantity} ({item_info['price']})")
         
-        current_time = get_moscow_time().strftime("%H:%M:%S")
-        message += f"\n🕒 _Обновлено: {current_time} МСК_"
-        return message
+        return "\n".join(lines) + "\n"
+    
+    def format_stock_footer(self, updated: datetime) -> str:
+        return f"\n🕒 _Обновлено: {updated.strftime('%H:%M:%S')} МСК_"
+    
+    def format_stock_message(self, stock_data: Dict) -> str:
+        if not stock_data:
+            return "❌ *Не удалось получить данные*"
+        return self.render_stock_body(stock_data) + self.format_stock_footer(get_moscow_time())
     
     async def send_channel_notification(self, bot: Bot, item_name: str, count: int) -> bool:
         """Отправляет уведомление о редком предмете в публичный канал"""
@@ -494,60 +1601,63 @@ class DiscordStockParser:
             
             logger.info(f"✅ Уведомление о {item_name} отправлено в канал {NOTIFICATION_CHANNEL_ID}")
             return True
+        except RetryAfter:
+            raise
         except TelegramError as e:
             logger.error(f"❌ Ошибка отправки в канал: {e}")
             return False
         except Exception as e:
             logger.error(f"❌ Неожиданная ошибка при отправке в канал: {e}")
             return False
-        """Проверяет, можно ли отправлять уведомления для предмета (глобальный кулдаун)"""
-        if item_name not in item_last_seen:
-            return True
-        now = get_moscow_time()
-        last_time = item_last_seen[item_name]
-        return (now - last_time).total_seconds() >= 90
     
-    def should_notify_item(self, item_name: str) -> bool:
+    def should_notify_item(self, item_name: str, scope: str = ITEM_SCOPE_USERS) -> bool:
         """Проверяет, можно ли отправлять уведомления для предмета (глобальный кулдаун)"""
-        if item_name not in item_last_seen:
-            return True
-        now = get_moscow_time()
-        last_time = item_last_seen[item_name]
-        return (now - last_time).total_seconds() >= 90
+        return item_last_seen.ready(scope, ITEM_SLOTS[item_name])
     
-    def can_send_to_user(self, user_id: int, item_name: str) -> bool:
-        if user_id not in user_sent_notifications:
-            return True
-        if item_name not in user_sent_notifications[user_id]:
-            return True
-        now = get_moscow_time()
-        last_time = user_sent_notifications[user_id][item_name]
-        return (now - last_time).total_seconds() >= USER_NOTIFICATION_COOLDOWN
+    def can_send_to_user(self, user_id: int, item_name: str, now: Optional[float] = None) -> bool:
+        return user_sent_notifications.ready(user_id, ITEM_SLOTS[item_name], now)
     
-    async def send_autostock_notification(self, bot: Bot, user_id: int, item_name: str, count: int) -> bool:
-        try:
+    def format_autostock_message(self, items: List[Tuple[str, int]]) -> str:
+        """Одно сообщение со всеми отслеживаемыми предметами из стока"""
+        current_time = get_moscow_time().strftime("%H:%M:%S")
+        
+        if len(items) == 1:
+            item_name, count = items[0]
             item_info = ITEMS_DATA.get(item_name, {"emoji": "📦", "price": "?"})
-            current_time = get_moscow_time().strftime("%H:%M:%S")
-            
-            message = (
+            return (
                 f"🔔 *АВТОСТОК - {item_name}!*\n\n"
                 f"{item_info['emoji']} *{item_name}*\n"
                 f"📦 Количество: *x{count}*\n"
                 f"💰 Цена: {item_info['price']}\n"
                 f"🕒 {current_time} МСК"
             )
-            
+        
+        lines = []
+        for item_name, count in items:
+            item_info = ITEMS_DATA.get(item_name, {"emoji": "📦", "price": "?"})
+            lines.append(f"{item_info['emoji']} *{item_name}*: x{count} ({item_info['price']})")
+        return (
+            f"🔔 *АВТОСТОК - {len(items)} предм.!*\n\n"
+            + "\n".join(lines)
+            + f"\n\n🕒 {current_time} МСК"
+        )
+    
+    async def send_autostock_notification(self, bot: Bot, user_id: int, items: List[Tuple[str, int]]) -> bool:
+        try:
+            message = self.format_autostock_message(items)
             await bot.send_message(chat_id=user_id, text=message, parse_mode=ParseMode.MARKDOWN)
             
-            if user_id not in user_sent_notifications:
-                user_sent_notifications[user_id] = {}
-            user_sent_notifications[user_id][item_name] = get_moscow_time()
+            sent_time = time.monotonic()
+            for item_name, _ in items:
+                user_sent_notifications.mark(user_id, ITEM_SLOTS[item_name], sent_time)
             
             return True
+        except RetryAfter:
+            raise
         except TelegramError as e:
-            error_msg = str(e).lower()
-            if "forbidden" in error_msg or "blocked" in error_msg or "bot was blocked" in error_msg or "user is deactivated" in error_msg:
+            if is_blocked_error(e):
                 logger.info(f"🚫 Пользователь {user_id} заблокировал бота или удалил аккаунт")
+                metrics.blocked_users.inc()
                 asyncio.create_task(self.cleanup_blocked_user(user_id))
                 return False
             else:
@@ -558,25 +1668,37 @@ class DiscordStockParser:
             return False
     
     async def cleanup_blocked_user(self, user_id: int):
+        await self.cleanup_blocked_users([user_id])
+    
+    async def cleanup_blocked_users(self, user_ids: List[int]):
+        """Удаляет заблокировавших бота из БД пачкой и из всех локальных структур"""
         try:
-            await self.db.delete_user_autostocks(user_id)
-            await self.db.delete_user(user_id)
+            await self.db.delete_users(user_ids)
             
-            user_autostocks_cache.pop(user_id, None)
-            user_autostocks_time.pop(user_id, None)
-            subscription_cache.pop(user_id, None)
-            user_sent_notifications.pop(user_id, None)
+            for user_id in user_ids:
+                user_autostocks_cache.pop(user_id, None)
+                subscriber_index.remove_user(user_id)
+                self.db.pending_toggles.pop(user_id, None)
+                subscription_cache.pop(user_id, None)
+                user_sent_notifications.discard(user_id)
             
-            logger.info(f"✅ Очищен {user_id}")
+            logger.info(f"✅ Очищено пользователей: {len(user_ids)}")
         except Exception as e:
-            logger.error(f"❌ Очистка {user_id}: {e}")
+            logger.error(f"❌ Очистка {user_ids[:5]}...: {e}")
     
-    async def check_user_autostocks(self, stock_data: Dict, bot: Bot):
-        """Проверяет автостоки и отправляет уведомления пользователям"""
+    async def check_user_autostocks(self, stock_data: Dict, bot: Bot, received_at: Optional[float] = None):
+        """Проверяет автостоки и отправляет уведомления пользователям.
+        
+        received_at — time.monotonic() получения restock, для сквозной задержки доставки.
+        """
         if not stock_data:
             logger.warning("❌ stock_data пустой")
             return
         
+        fanout_started = time.monotonic()
+        if received_at is None:
+            received_at = fanout_started
+        
         logger.info(f"🔍 Начало проверки автостоков. Данные: {stock_data}")
         
         current_stock = {}
@@ -595,17 +1717,26 @@ class DiscordStockParser:
         for item_name, count in current_stock.items():
             if item_name in NOTIFICATION_ITEMS:
                 # Проверяем, отправляли ли уже уведомление в канал для этого предмета
-                if self.should_notify_item(f"channel_{item_name}"):
+                if self.should_notify_item(item_name, ITEM_SCOPE_CHANNEL):
                     logger.info(f"📢 Отправка уведомления в канал для {item_name}")
-                    await self.send_channel_notification(bot, item_name, count)
-                    item_last_seen[f"channel_{item_name}"] = get_moscow_time()
+                    try:
+                        await notification_dispatcher.run(self.send_channel_notification, bot, item_name, count)
+                    except TelegramError as e:
+                        logger.error(f"❌ Ошибка отправки в канал: {e}")
+                    item_last_seen.mark(ITEM_SCOPE_CHANNEL, ITEM_SLOTS[item_name])
         
         # Параллельная загрузка пользователей для всех предметов
         item_names = list(current_stock.keys())
         logger.info(f"🔎 Загружаем пользователей для предметов: {item_names}")
         
-        user_tasks = [self.db.get_users_tracking_item(item_name) for item_name in item_names]
-        users_results = await asyncio.gather(*user_tasks, return_exceptions=True)
+        lookup_started = time.perf_counter()
+        if subscriber_index.loaded:
+            users_results = [subscriber_index.users_for(item_name) for item_name in item_names]
+        else:
+            logger.warning("⚠️ Индекс подписчиков не загружен, запрос к БД")
+            user_tasks = [self.db.get_users_tracking_item(item_name) for item_name in item_names]
+            users_results = await asyncio.gather(*user_tasks, return_exceptions=True)
+        metrics.lookup_seconds.observe(time.perf_counter() - lookup_started)
         
         item_users_map = {}
         for item_name, result in zip(item_names, users_results):
@@ -614,7 +1745,7 @@ class DiscordStockParser:
                 continue
             if result:
                 item_users_map[item_name] = result
-                logger.info(f"👥 {item_name}: {len(result)} пользователей отслеживают → {result}")
+                logger.info(f"👥 {item_name}: {len(result)} пользователей отслеживают")
             else:
                 logger.info(f"📭 {item_name}: нет пользователей")
         
@@ -622,79 +1753,327 @@ class DiscordStockParser:
             logger.warning("📭 Нет пользователей для уведомлений")
             return
         
-        # Отправка уведомлений по каждому предмету
-        for item_name, count in current_stock.items():
-            logger.info(f"🔔 Обработка предмета: {item_name} (x{count})")
-            
-            # Проверяем глобальный кулдаун для предмета
+        # Предметы, прошедшие глобальный кулдаун, начиная с самых редких
+        notify_items = []
+        for item_name in sorted(current_stock, key=lambda name: ITEM_FANOUT_ORDER.get(name, (True, 0))):
             if not self.should_notify_item(item_name):
-                last_time = item_last_seen.get(item_name)
-                if last_time:
-                    elapsed = (get_moscow_time() - last_time).total_seconds()
-                    logger.warning(f"⏸️ {item_name}: глобальный кулдаун активен (прошло {elapsed:.0f}s из 90s)")
+                elapsed = ITEM_NOTIFY_COOLDOWN - item_last_seen.remaining(ITEM_SCOPE_USERS, ITEM_SLOTS[item_name])
+                logger.warning(f"⏸️ {item_name}: глобальный кулдаун активен (прошло {elapsed:.0f}s из {ITEM_NOTIFY_COOLDOWN}s)")
                 continue
             
-            users = item_users_map.get(item_name, [])
-            if not users:
+            if not item_users_map.get(item_name):
                 logger.info(f"📭 {item_name}: нет пользователей для уведомления")
                 continue
             
-            logger.info(f"🚀 Отправка уведомлений для {item_name} → {len(users)} пользователям: {users}")
-            item_last_seen[item_name] = get_moscow_time()
-            
-            sent = 0
-            skipped = 0
-            errors = 0
-            
-            # Отправка небольшими пакетами для избежания rate limits
-            batch_size = 25
-            for i in range(0, len(users), batch_size):
-                batch = users[i:i + batch_size]
-                send_tasks = []
-                
-                for user_id in batch:
-                    # Проверяем персональный кулдаун пользователя
-                    if not self.can_send_to_user(user_id, item_name):
-                        last_notif = user_sent_notifications.get(user_id, {}).get(item_name)
-                        if last_notif:
-                            elapsed = (get_moscow_time() - last_notif).total_seconds()
-                            logger.debug(f"⏸️ {item_name} → user {user_id}: персональный кулдаун (прошло {elapsed:.0f}s из 120s)")
-                        skipped += 1
-                        continue
-                    
-                    logger.info(f"✉️ Отправка {item_name} → user {user_id}")
-                    send_tasks.append(self.send_autostock_notification(bot, user_id, item_name, count))
-                
-                if send_tasks:
-                    results = await asyncio.gather(*send_tasks, return_exceptions=True)
-                    for idx, result in enumerate(results):
-                        if result is True:
-                            sent += 1
-                            logger.info(f"✅ Успешно отправлено user {batch[idx]}")
-                        elif isinstance(result, Exception):
-                            errors += 1
-                            logger.error(f"❌ Ошибка отправки user {batch[idx]}: {result}")
-                        else:
-                            logger.warning(f"⚠️ Неожиданный результат для user {batch[idx]}: {result}")
-                    
-                    # Небольшая задержка между пакетами
-                    if i + batch_size < len(users):
-                        await asyncio.sleep(0.1)
-            
-            logger.info(f"📊 {item_name} итоги: ✅ отправлено {sent}, ⏸️ пропущено {skipped}, ❌ ошибок {errors}")
-            
-            # Задержка между разными предметами
-            await asyncio.sleep(0.05)
+            item_last_seen.mark(ITEM_SCOPE_USERS, ITEM_SLOTS[item_name])
+            notify_items.append(item_name)
+        
+        # Группируем по пользователям: одно сообщение со всеми его предметами.
+        # Порядок вставки сохраняет приоритет: первыми идут получатели редких предметов
+        user_masks: Dict[int, int] = {}
+        skipped = 0
+        now = time.monotonic()
+        for item_name in notify_items:
+            bit = ITEM_BITS[item_name]
+            slot = ITEM_SLOTS[item_name]
+            recipients = 0
+            for user_id in item_users_map[item_name]:
+                # Проверяем персональный кулдаун пользователя по предмету
+                if not user_sent_notifications.ready(user_id, slot, now):
+                    skipped += 1
+                    continue
+                user_masks[user_id] = user_masks.get(user_id, 0) | bit
+                recipients += 1
+            metrics.item_recipients.inc(recipients, (item_name,))
+        
+        logger.info(f"🚀 Отправка уведомлений: {len(user_masks)} пользователям по {len(notify_items)} предметам")
+        
+        notify_bits = [(ITEM_BITS[name], name, current_stock[name]) for name in notify_items]
+        jobs = [
+            (user_id, [(name, count) for bit, name, count in notify_bits if mask & bit])
+            for user_id, mask in user_masks.items()
+        ]
+        if fanout_pool is not None:
+            sent, errors, deliveries = await self._fanout_sharded(bot, jobs)
+        else:
+            sent, errors, deliveries = await self._fanout_local(bot, jobs)
+        
+        metrics.sends.inc(sent)
+        metrics.send_errors.inc(errors)
+        metrics.fanout_seconds.observe(time.monotonic() - fanout_started)
+        if deliveries:
+            first, last = min(deliveries), max(deliveries)
+            metrics.first_delivery_seconds.observe(first - received_at)
+            metrics.last_delivery_seconds.observe(last - received_at)
+            metrics.fanout_rate.set(sent / max(last - fanout_started, 0.001))
+        
+        logger.info(f"📊 Итоги: ✅ отправлено {sent}, ⏸️ пропущено {skipped}, ❌ ошибок {errors}")
         
         logger.info("✅ Проверка автостоков завершена")
+    
+    async def _fanout_local(self, bot: Bot, jobs: List[Tuple[int, List[Tuple[str, int]]]]) -> Tuple[int, int, List[float]]:
+        """Отправка в основном event loop; возвращает (отправлено, ошибок, моменты доставки)"""
+        # Время первой и последней доставки фиксируется в момент завершения отправки
+        deliveries: List[float] = []
+        
+        def on_sent(future: asyncio.Future):
+            if not future.cancelled() and future.exception() is None and future.result():
+                deliveries.append(time.monotonic())
+        
+        futures = []
+        for user_id, items in jobs:
+            logger.debug(f"✉️ Отправка {[name for name, _ in items]} → user {user_id}")
+            future = await notification_dispatcher.submit(self.send_autostock_notification, bot, user_id, items)
+            future.add_done_callback(on_sent)
+            futures.append((user_id, future))
+        
+        sent = 0
+        errors = 0
+        for user_id, future in futures:
+            try:
+                if await future:
+                    sent += 1
+                else:
+                    errors += 1
+            except Exception as e:
+                errors += 1
+                logger.error(f"❌ Ошибка отправки user {user_id}: {e}")
+        return sent, errors, deliveries
+    
+    async def _fanout_sharded(self, bot: Bot, jobs: List[Tuple[int, List[Tuple[str, int]]]]) -> Tuple[int, int, List[float]]:
+        """Шарды по user_id уходят в процессы fan-out; кулдауны и очистка остаются здесь"""
+        shards: List[List[Tuple[int, List[Tuple[str, int]]]]] = [[] for _ in range(FANOUT_WORKER_PROCESSES)]
+        for job in jobs:
+            shards[job[0] % FANOUT_WORKER_PROCESSES].append(job)
+        shards = [shard for shard in shards if shard]
+        
+        # Процессы отмечают доставленных в файлах прогресса: при сбое шарда повторно шлём только остальным
+        progress_dir = tempfile.mkdtemp(prefix="pvb-fanout-")
+        progress_paths = [os.path.join(progress_dir, f"shard{index}.txt") for index in range(len(shards))]
+        loop = asyncio.get_running_loop()
+        
+        def submit(shard, path):
+            try:
+                return loop.run_in_executor(fanout_pool, fanout_worker_deliver, shard, path)
+            except BrokenProcessPool:
+                # Пул сломался после прошлого restock (процесс упал) — поднимаем заново
+                restart_fanout_pool()
+                return loop.run_in_executor(fanout_pool, fanout_worker_deliver, shard, path)
+        
+        with fanout_shards_running():
+            try:
+                results = await asyncio.gather(
+                    *(submit(shard, path) for shard, path in zip(shards, progress_paths)),
+                    return_exceptions=True
+                )
+                reached = [
+                    read_shard_progress(path) if isinstance(result, Exception) else set()
+                    for path, result in zip(progress_paths, results)
+                ]
+            finally:
+                shutil.rmtree(progress_dir, ignore_errors=True)
+        if any(isinstance(result, BrokenProcessPool) for result in results):
+            restart_fanout_pool()
+        
+        sent = 0
+        errors = 0
+        deliveries: List[float] = []
+        blocked: List[int] = []
+        for shard, result, delivered in zip(shards, results, reached):
+            if isinstance(result, Exception):
+                now = time.monotonic()
+                for user_id, items in shard:
+                    if user_id in delivered:
+                        for item_name, _ in items:
+                            user_sent_notifications.mark(user_id, ITEM_SLOTS[item_name], now)
+                remaining = [job for job in shard if job[0] not in delivered]
+                logger.error(
+                    f"❌ Процесс fan-out не обработал шард ({len(shard)} польз.): {result}; "
+                    f"доставлено {len(delivered)}, {len(remaining)} отправляем локально"
+                )
+                shard_sent, shard_errors, shard_deliveries = await self._fanout_local(bot, remaining)
+                sent += len(delivered) + shard_sent
+                errors += shard_errors
+                deliveries.extend(shard_deliveries)
+                continue
+            
+            now = time.monotonic()
+            items_by_user = dict(shard)
+            for user_id in result["sent"]:
+                for item_name, _ in items_by_user[user_id]:
+                    user_sent_notifications.mark(user_id, ITEM_SLOTS[item_name], now)
+            sent += len(result["sent"])
+            errors += result["errors"] + len(result["blocked"])
+            blocked.extend(result["blocked"])
+            deliveries.extend(result["deliveries"])
+            metrics.send_seconds.merge(result["send_seconds"])
+            metrics.retry_after.inc(result["retry_after"])
+        
+        if blocked:
+            logger.info(f"🚫 Заблокировали бота: {len(blocked)} пользователей")
+            metrics.blocked_users.inc(len(blocked))
+            asyncio.create_task(self.cleanup_blocked_users(blocked))
+        return sent, errors, deliveries
 
 parser = DiscordStockParser()
 
+# ========== ПРОЦЕССЫ FAN-OUT ==========
+# Состояние процесса-воркера; в основном процессе не используется
+_worker_loop: Optional[asyncio.AbstractEventLoop] = None
+_worker_bot: Optional[Bot] = None
+_worker_bot_ready = False
+# Сколько restock сейчас рассылается процессами fan-out (в основном процессе)
+fanout_shards_active = 0
+
+def fanout_worker_init(token: str, rate: float, workers: int, shared_pause):
+    """Запуск процесса-воркера: свой event loop, свой Bot с пулом соединений и своя доля лимита.
+    
+    Без сетевых вызовов: ошибка в initializer ломает весь ProcessPoolExecutor,
+    поэтому Bot инициализируется при первом шарде.
+    """
+    global _worker_loop, _worker_bot, notification_dispatcher
+    _worker_loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(_worker_loop)
+    _worker_bot = Bot(token, request=HTTPXRequest(connection_pool_size=workers + 2))
+    notification_dispatcher = NotificationDispatcher(rate, DISPATCH_QUEUE_SIZE, workers)
+    notification_dispatcher.bucket.shared_pause = shared_pause
+
+def fanout_worker_ping() -> int:
+    return os.getpid()
+
+def fanout_worker_deliver(jobs: List[Tuple[int, List[Tuple[str, int]]]], progress_path: str) -> Dict:
+    return _worker_loop.run_until_complete(_deliver_shard(jobs, progress_path))
+
+def read_shard_progress(path: str) -> Set[int]:
+    """user_id, которым процесс fan-out успел доставить сообщение до сбоя"""
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            lines = f.read().split("\n")
+    except FileNotFoundError:
+        return set()
+    # Последняя строка может быть оборвана на середине
+    return {int(line) for line in lines if line.isdigit()}
+
+async def _deliver_shard(jobs: List[Tuple[int, List[Tuple[str, int]]]], progress_path: str) -> Dict:
+    """Отправляет шард и возвращает итоги; состояние бота меняет координатор.
+    
+    Каждая доставка сразу дописывается в progress_path, чтобы координатор
+    при сбое процесса не отправил её повторно.
+    """
+    global _worker_bot_ready
+    if not _worker_bot_ready:
+        # Сбой getMe здесь — ошибка одного шарда, а не сломанный пул
+        await _worker_bot.initialize()
+        _worker_bot_ready = True
+    metrics.send_seconds = Histogram(metrics.send_seconds.name, metrics.send_seconds.help_text)
+    retry_after_before = metrics.retry_after.values.get((), 0)
+    deliveries: List[float] = []
+    
+    async def deliver(user_id: int, items: List[Tuple[str, int]]) -> str:
+        try:
+            message = parser.format_autostock_message(items)
+            await _worker_bot.send_message(chat_id=user_id, text=message, parse_mode=ParseMode.MARKDOWN)
+            progress.write(f"{user_id}\n")
+            deliveries.append(time.monotonic())
+            return "sent"
+        except RetryAfter:
+            raise
+        except TelegramError as e:
+            if is_blocked_error(e):
+                return "blocked"
+            logger.warning(f"⚠️ Ошибка отправки {user_id}: {e}")
+            return "failed"
+    
+    result = {"sent": [], "blocked": [], "errors": 0}
+    futures = []
+    # Построчная буферизация: каждая запись уходит в файл сразу и переживает падение процесса
+    with open(progress_path, "a", encoding="utf-8", buffering=1) as progress:
+        try:
+            for user_id, items in jobs:
+                futures.append((user_id, await notification_dispatcher.submit(deliver, user_id, items)))
+            
+            for user_id, future in futures:
+                try:
+                    status = await future
+                except Exception as e:
+                    logger.error(f"❌ Ошибка отправки user {user_id}: {e}")
+                    status = "failed"
+                if status == "sent":
+                    result["sent"].append(user_id)
+                elif status == "blocked":
+                    result["blocked"].append(user_id)
+                else:
+                    result["errors"] += 1
+        finally:
+            # При сбое шард досылает координатор: оставшиеся в очереди задачи не должны уйти позже
+            for _, future in futures:
+                future.cancel()
+    
+    # time.monotonic() общий для процессов одной машины
+    result["deliveries"] = [min(deliveries), max(deliveries)] if deliveries else []
+    result["send_seconds"] = metrics.send_seconds.state()
+    result["retry_after"] = metrics.retry_after.values.get((), 0) - retry_after_before
+    return result
+
+def start_fanout_pool() -> Optional[ProcessPoolExecutor]:
+    global fanout_pool
+    if FANOUT_WORKER_PROCESSES <= 0:
+        return None
+    import multiprocessing
+    
+    # spawn, а не fork: к этому моменту в процессе уже есть потоки и открытые соединения
+    context = multiprocessing.get_context("spawn")
+    # Пауза после RetryAfter общая для всех процессов через shared_pause
+    shared_pause = context.Value("d", 0.0)
+    notification_dispatcher.bucket.shared_pause = shared_pause
+    worker_rate = (TELEGRAM_GLOBAL_RATE - main_fanout_rate()) / FANOUT_WORKER_PROCESSES
+    
+    fanout_pool = ProcessPoolExecutor(
+        max_workers=FANOUT_WORKER_PROCESSES,
+        mp_context=context,
+        initializer=fanout_worker_init,
+        initargs=(
+            BOT_TOKEN,
+            worker_rate,
+            max(4, DISPATCH_WORKERS // FANOUT_WORKER_PROCESSES),
+            shared_pause,
+        )
+    )
+    logger.info(f"🧵 Процессы fan-out: {FANOUT_WORKER_PROCESSES} по {worker_rate:.1f} msg/s, основной на время fan-out — {main_fanout_rate()} msg/s")
+    return fanout_pool
+
+def restart_fanout_pool():
+    """Заменяет сломанный пул (упавший процесс, BrokenProcessPool) новым"""
+    global fanout_pool
+    logger.warning("♻️ Пул процессов fan-out сломан, создаём заново")
+    if fanout_pool is not None:
+        fanout_pool.shutdown(wait=False, cancel_futures=True)
+        fanout_pool = None
+    start_fanout_pool()
+
+def main_fanout_rate() -> float:
+    return min(FANOUT_MAIN_RATE, TELEGRAM_GLOBAL_RATE)
+
+@contextmanager
+def fanout_shards_running():
+    """Пока процессы fan-out шлют шарды, основной процесс ужимается до своей доли лимита"""
+    global fanout_shards_active
+    bucket = notification_dispatcher.bucket
+    fanout_shards_active += 1
+    bucket.set_rate(main_fanout_rate())
+    try:
+        yield
+    finally:
+        fanout_shards_active -= 1
+        if not fanout_shards_active:
+            bucket.set_rate(TELEGRAM_GLOBAL_RATE)
+
 # ========== DISCORD CLIENT ==========
 class PVBDiscordClient(discord.Client):
     def __init__(self):
         super().__init__()
         self.stock_channel = None
+        self._refresh_task: Optional[asyncio.Task] = None
     
     async def on_ready(self):
         logger.info(f'✅ Discord подключен: {self.user}')
@@ -704,6 +2083,11 @@ class PVBDiscordClient(discord.Client):
         else:
             logger.error("❌ Канал стоков не найден!")
     
+    async def on_disconnect(self):
+        # Пока нет соединения, restock мог пройти мимо — следующий /stock перепроверит историю
+        global stock_from_gateway
+        stock_from_gateway = False
+    
     async def on_message(self, message: discord.Message):
         """Реакция на новые сообщения в канале стоков"""
         if message.channel.id != DISCORD_STOCK_CHANNEL_ID:
@@ -729,45 +2113,72 @@ class PVBDiscordClient(discord.Client):
         logger.info(f"От: {message.author.name}")
         logger.info(f"Время: {get_moscow_time().strftime('%H:%M:%S')}")
         
+        # Повтор события шлюза или репост того же стока отсекаем до парсинга
+        if not restock_dedup.claim(message.id, restock_dedup.digest(message.content, message.embeds)):
+            logger.info(f"♻️ Restock {message.id} уже обработан, пропускаем")
+            metrics.duplicate_restocks.inc()
+            return
+        asyncio.create_task(restock_dedup.save())
+        
+        received_at = time.monotonic()
+        metrics.restocks.inc()
+        
         try:
             # Парсим сообщение
             stock_data = parser.parse_stock_message(message.content, message.embeds)
+            metrics.parse_seconds.observe(time.monotonic() - received_at)
             
             if not stock_data['seeds'] and not stock_data['gear']:
                 logger.warning("⚠️ Не удалось распарсить стоки")
                 return
             
             # Обновляем кэш
-            global stock_cache, stock_cache_time
-            stock_cache = stock_data
-            stock_cache_time = get_moscow_time()
+            update_stock_cache(stock_data, from_gateway=True)
+            asyncio.create_task(restock_history.record(stock_data, message.id))
             
             logger.info(f"✅ Стоки обновлены в кэше: {len(stock_data['seeds'])} семян, {len(stock_data['gear'])} снаряжения")
             logger.info(f"📦 Детали стоков: {stock_data}")
             
-            # Получаем telegram bot из глобальной переменной telegram_app
-            if telegram_app and telegram_app.bot:
+            # Discord мог подключиться раньше, чем Telegram закончил старт
+            if telegram_ready and not telegram_ready.is_set():
+                logger.info("⏳ Ожидание запуска Telegram для отправки уведомлений...")
+                await telegram_ready.wait()
+            
+            # Уведомления идут через notify_bot, не занимая пул интерактивных ответов
+            if notify_bot:
                 logger.info("🚀 Запуск отправки уведомлений...")
-                await parser.check_user_autostocks(stock_data, telegram_app.bot)
+                await parser.check_user_autostocks(stock_data, notify_bot, received_at)
             else:
-                logger.error("❌ Telegram app не инициализирован!")
+                logger.error("❌ Telegram bot для уведомлений не инициализирован!")
         except Exception as e:
             logger.error(f"❌ Ошибка обработки сообщения: {e}", exc_info=True)
     
     async def fetch_latest_stock(self) -> Dict:
-        """Получение последних стоков из истории"""
-        global stock_cache, stock_cache_time
-        
-        now = get_moscow_time()
-        if stock_cache and stock_cache_time:
-            if (now - stock_cache_time).total_seconds() < STOCK_CACHE_SECONDS:
+        """Сток из кэша; устаревший отдаётся сразу, а обновление идёт в фоне"""
+        if stock_cache:
+            fresh = (get_moscow_time() - stock_cache_time).total_seconds() < STOCK_CACHE_SECONDS
+            if stock_from_gateway or fresh:
                 logger.debug("📦 Возврат из кэша")
                 return stock_cache
+            self._start_refresh()
+            return stock_cache
         
+        # Кэша нет совсем — ждём общее обновление
+        return await asyncio.shield(self._start_refresh())
+    
+    def _start_refresh(self) -> asyncio.Task:
+        """Одно обновление из истории на всех одновременных запросов"""
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.create_task(self._refresh_from_history())
+        return self._refresh_task
+    
+    async def _refresh_from_history(self) -> Dict:
+        """Получение последних стоков из истории"""
         if not self.stock_channel:
             logger.error("❌ Канал стоков недоступен")
-            return {"seeds": [], "gear": []}
+            return stock_cache or {"seeds": [], "gear": []}
         
+        started = get_moscow_time()
         try:
             logger.info("🔍 Поиск последнего stock сообщения в истории...")
             
@@ -786,16 +2197,217 @@ class PVBDiscordClient(discord.Client):
                     stock_data = parser.parse_stock_message(msg.content, msg.embeds)
                     
                     if stock_data['seeds'] or stock_data['gear']:
-                        stock_cache = stock_data
-                        stock_cache_time = now
+                        # Не затираем restock, пришедший через gateway во время запроса
+                        if stock_cache_time and stock_cache_time > started:
+                            return stock_cache
+                        update_stock_cache(stock_data)
                         logger.info(f"📦 Загружено: {len(stock_data['seeds'])} семян, {len(stock_data['gear'])} снаряжения")
                         return stock_data
             
             logger.warning("⚠️ Stock сообщения не найдены в истории")
-            return {"seeds": [], "gear": []}
+            return stock_cache or {"seeds": [], "gear": []}
         except Exception as e:
             logger.error(f"❌ fetch_latest_stock: {e}", exc_info=True)
-            return {"seeds": [], "gear": []}
+            return stock_cache or {"seeds": [], "gear": []}
+
+# ========== РАССЫЛКА ==========
+class BroadcastJob:
+    """Рассылка всем пользователям с контрольной точкой на диске.
+    
+    Получатели читаются постранично по возрастанию user_id. В контрольной точке
+    хранится наибольший user_id, до которого все отправки завершены, поэтому после
+    перезапуска рассылка продолжается с него без пропусков.
+    """
+    def __init__(self, text: str, admin_chat_id: int, state: Optional[Dict] = None):
+        state = state or {}
+        self.text = text
+        self.admin_chat_id = admin_chat_id
+        self.last_user_id: Optional[int] = state.get("last_user_id")
+        self.sent = state.get("sent", 0)
+        self.blocked = state.get("blocked", 0)
+        self.failed = state.get("failed", 0)
+        self.started_at = state.get("started_at", time.time())
+        self.stopped = False
+        self.progress_message_id: Optional[int] = None
+        self.pending_blocked: List[int] = []
+        self.task: Optional[asyncio.Task] = None
+        self._run_started = time.monotonic()
+        self._run_processed = self.processed
+    
+    @property
+    def processed(self) -> int:
+        return self.sent + self.blocked + self.failed
+    
+    @property
+    def running(self) -> bool:
+        return self.task is not None and not self.task.done()
+    
+    def throughput(self) -> float:
+        elapsed = time.monotonic() - self._run_started
+        return (self.processed - self._run_processed) / elapsed if elapsed > 0 else 0.0
+    
+    def state(self) -> Dict:
+        return {
+            "text": self.text,
+            "admin_chat_id": self.admin_chat_id,
+            "last_user_id": self.last_user_id,
+            "sent": self.sent,
+            "blocked": self.blocked,
+            "failed": self.failed,
+            "started_at": self.started_at,
+        }
+    
+    @classmethod
+    def load(cls) -> Optional["BroadcastJob"]:
+        try:
+            with open(BROADCAST_CHECKPOINT_FILE, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning(f"⚠️ Не удалось прочитать {BROADCAST_CHECKPOINT_FILE}: {e}")
+            return None
+        try:
+            return cls(state["text"], state["admin_chat_id"], state)
+        except (KeyError, TypeError) as e:
+            logger.error(f"❌ Повреждённая контрольная точка рассылки {BROADCAST_CHECKPOINT_FILE}: {e!r}")
+            return None
+    
+    async def save(self):
+        try:
+            await asyncio.to_thread(write_json_atomic, BROADCAST_CHECKPOINT_FILE, self.state())
+        except OSError as e:
+            logger.warning(f"⚠️ Не удалось сохранить {BROADCAST_CHECKPOINT_FILE}: {e}")
+    
+    def clear(self):
+        try:
+            os.remove(BROADCAST_CHECKPOINT_FILE)
+        except FileNotFoundError:
+            pass
+    
+    def start(self, bot: Bot):
+        self.task = asyncio.create_task(self.run(bot))
+    
+    def stop(self):
+        # Уже поставленные в очередь отправки увидят флаг и не уйдут в Telegram
+        self.stopped = True
+        if self.task:
+            self.task.cancel()
+    
+    async def _send(self, bot: Bot, user_id: int) -> str:
+        if self.stopped:
+            return "cancelled"
+        try:
+            # Текст админа как есть: непарный * или _ в Markdown сломал бы каждую отправку
+            await bot.send_message(chat_id=user_id, text=self.text)
+            return "sent"
+        except RetryAfter:
+            raise
+        except TelegramError as e:
+            if is_blocked_error(e):
+                return "blocked"
+            logger.warning(f"⚠️ Рассылка {user_id}: {e}")
+            return "failed"
+    
+    def _collect(self, pending: deque):
+        """Учитывает завершённые отправки по порядку user_id и двигает контрольную точку"""
+        while pending and pending[0][1].done():
+            user_id, future = pending.popleft()
+            status = "failed" if future.cancelled() or future.exception() else future.result()
+            if status == "cancelled":
+                continue
+            if status == "sent":
+                self.sent += 1
+            elif status == "blocked":
+                self.blocked += 1
+                self.pending_blocked.append(user_id)
+            else:
+                self.failed += 1
+            self.last_user_id = user_id
+    
+    async def _prune(self, force: bool = False):
+        if self.pending_blocked and (force or len(self.pending_blocked) >= BROADCAST_PRUNE_BATCH):
+            user_ids, self.pending_blocked = self.pending_blocked, []
+            await parser.cleanup_blocked_users(user_ids)
+    
+    def progress_text(self, status: str) -> str:
+        return (
+            f"📣 *РАССЫЛКА* — {status}\n\n"
+            f"✅ Доставлено: {self.sent}\n"
+            f"🚫 Заблокировали: {self.blocked}\n"
+            f"❌ Ошибок: {self.failed}\n"
+            f"⚡ Скорость: {self.throughput():.1f} сообщ./сек\n"
+            f"📍 Последний user\\_id: {self.last_user_id or '—'}"
+        )
+    
+    async def report(self, bot: Bot, status: str):
+        text = self.progress_text(status)
+        try:
+            if self.progress_message_id is None:
+                message = await bot.send_message(chat_id=self.admin_chat_id, text=text, parse_mode=ParseMode.MARKDOWN)
+                self.progress_message_id = message.message_id
+            else:
+                await bot.edit_message_text(
+                    chat_id=self.admin_chat_id, message_id=self.progress_message_id,
+                    text=text, parse_mode=ParseMode.MARKDOWN
+                )
+        except TelegramError as e:
+            logger.debug(f"Отчёт о рассылке не обновлён: {e}")
+    
+    async def run(self, bot: Bot):
+        pending: deque = deque()
+        last_report = time.monotonic()
+        logger.info(f"📣 Рассылка запущена с user_id > {self.last_user_id}")
+        await self.report(bot, "идёт")
+        try:
+            async for user_id in parser.db.iter_users(after=self.last_user_id):
+                # submit ждёт места в очереди — это и есть backpressure
+                pending.append((user_id, await broadcast_dispatcher.submit(self._send, bot, user_id)))
+                self._collect(pending)
+                await self._prune()
+                
+                if time.monotonic() - last_report >= BROADCAST_PROGRESS_SECONDS:
+                    last_report = time.monotonic()
+                    await self.save()
+                    await self.report(bot, "идёт")
+            
+            if pending:
+                await asyncio.wait([future for _, future in pending])
+                self._collect(pending)
+            await self._prune(force=True)
+        except asyncio.CancelledError:
+            self._collect(pending)
+            if self.stopped:
+                self.clear()
+                await self.report(bot, "остановлена")
+            else:
+                await self.save()
+            raise
+        except Exception as e:
+            logger.error(f"❌ Рассылка прервана: {e}", exc_info=True)
+            self._collect(pending)
+            await self.save()
+            await self.report(bot, "прервана, продолжится после перезапуска")
+            return
+        
+        self.clear()
+        logger.info(f"📣 Рассылка завершена: ✅ {self.sent}, 🚫 {self.blocked}, ❌ {self.failed}")
+        await self.report(bot, "завершена")
+
+async def resume_broadcast():
+    """Продолжает рассылку, прерванную перезапуском"""
+    global broadcast_job
+    try:
+        job = await asyncio.to_thread(BroadcastJob.load)
+    except Exception as e:
+        logger.error(f"❌ Не удалось восстановить рассылку: {e}", exc_info=True)
+        return
+    if job is None:
+        return
+    await telegram_ready.wait()
+    logger.info(f"♻️ Возобновление рассылки после user_id {job.last_user_id}")
+    broadcast_job = job
+    job.start(notify_bot)
 
 # ========== КОМАНДЫ ==========
 async def check_subscription_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -826,7 +2438,7 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     user = update.effective_user
-    asyncio.create_task(parser.db.save_user(user.id, user.username, user.first_name))
+    parser.db.queue_user(user.id, user.username, user.first_name)
     
     welcome_message = (
         "👋 *Plants vs Brainrots Stock Tracker!*\n\n"
@@ -843,7 +2455,7 @@ async def stock_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     user_id = update.effective_user.id
-    asyncio.create_task(parser.db.save_user(user_id, update.effective_user.username, update.effective_user.first_name))
+    parser.db.queue_user(user_id, update.effective_user.username, update.effective_user.first_name)
     
     if update.effective_chat.type == ChatType.PRIVATE:
         is_subscribed, not_subscribed = await check_subscription(user_id, context.bot)
@@ -857,11 +2469,23 @@ async def stock_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
     
     if not discord_client or not discord_client.is_ready():
-        await update.effective_message.reply_text("⚠️ *Discord загружается...*", parse_mode=ParseMode.MARKDOWN)
+        # Пока Discord подключается, отдаём последний известный сток (из кэша или истории)
+        if stock_cache and stock_message_body is not None:
+            message = (
+                stock_message_body + parser.format_stock_footer(stock_cache_time)
+                + "\n⏳ _Discord подключается, сток может быть неактуален_"
+            )
+            await update.effective_message.reply_text(message, parse_mode=ParseMode.MARKDOWN)
+        else:
+            await update.effective_message.reply_text("⚠️ *Discord загружается...*", parse_mode=ParseMode.MARKDOWN)
         return
     
     stock_data = await discord_client.fetch_latest_stock()
-    message = parser.format_stock_message(stock_data)
+    if stock_data is stock_cache and stock_message_body is not None:
+        # Текст текущего стока уже готов, добавляем только время
+        message = stock_message_body + parser.format_stock_footer(stock_cache_time)
+    else:
+        message = parser.format_stock_message(stock_data)
     await update.effective_message.reply_text(message, parse_mode=ParseMode.MARKDOWN)
 
 async def autostock_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -872,7 +2496,7 @@ async def autostock_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     user_id = update.effective_user.id
-    asyncio.create_task(parser.db.save_user(user_id, update.effective_user.username, update.effective_user.first_name))
+    parser.db.queue_user(user_id, update.effective_user.username, update.effective_user.first_name)
     
     is_subscribed, not_subscribed = await check_subscription(user_id, context.bot)
     if not is_subscribed:
@@ -907,8 +2531,11 @@ async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     stats = (
         f"📊 *СТАТИСТИКА*\n\n"
         f"*Кэши:*\n"
-        f"• Автостоки: {len(user_autostocks_cache)}\n"
-        f"• Подписки: {len(subscription_cache)}\n"
+        f"• Автостоки: {user_autostocks_cache.stats_text()}\n"
+        f"• Подписки: {subscription_cache.stats_text()}\n"
+        f"• Индекс: {len(subscriber_index)} подписок\n"
+        f"• Очередь отправки: {notification_dispatcher.queue.qsize()} (RetryAfter: {notification_dispatcher.retries})\n"
+        f"• Очередь рассылки: {broadcast_dispatcher.queue.qsize()}\n"
         f"• Уведомления: {len(user_sent_notifications)}\n"
         f"• Предметы: {len(item_last_seen)}\n\n"
         f"*Discord:* {'✅' if discord_client and discord_client.is_ready() else '❌'}\n"
@@ -917,6 +2544,91 @@ async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     await update.effective_message.reply_text(stats, parse_mode=ParseMode.MARKDOWN)
 
+async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    global broadcast_job
+    if not update.effective_user or not update.effective_message:
+        return
+    
+    if update.effective_user.id != ADMIN_ID:
+        return
+    
+    running = broadcast_job is not None and broadcast_job.running
+    
+    if not context.args:
+        if running:
+            await update.effective_message.reply_text(broadcast_job.progress_text("идёт"), parse_mode=ParseMode.MARKDOWN)
+        else:
+            await update.effective_message.reply_text(
+                "📣 /broadcast <текст> - рассылка всем пользователям\n"
+                "⏹️ /broadcast stop - остановить"
+            )
+        return
+    
+    if context.args == ["stop"]:
+        if running:
+            broadcast_job.stop()
+        else:
+            await update.effective_message.reply_text("ℹ️ Рассылка не идёт")
+        return
+    
+    if running:
+        await update.effective_message.reply_text("⚠️ Рассылка уже идёт: /broadcast stop, чтобы остановить")
+        return
+    
+    # Текст целиком, с переносами строк, которые context.args теряет
+    text = update.effective_message.text.split(maxsplit=1)[1]
+    broadcast_job = BroadcastJob(text, update.effective_chat.id)
+    await broadcast_job.save()
+    broadcast_job.start(notify_bot)
+
+def format_item_history(item_name: str, rollup: ItemRollup) -> str:
+    item_info = ITEMS_DATA.get(item_name, {"emoji": "📦"})
+    last_seen = datetime.fromtimestamp(rollup.last_seen, pytz.timezone('Europe/Moscow'))
+    average_interval = rollup.average_interval
+    lines = [
+        f"{item_info['emoji']} *{item_name}*\n",
+        f"🕒 Последний раз: {last_seen.strftime('%d.%m %H:%M:%S')} МСК ({format_duration(time.time() - rollup.last_seen)} назад)",
+        f"🔁 Появлений: {rollup.appearances}",
+        f"⏱️ Средний интервал: {format_duration(average_interval) if average_interval is not None else '—'}",
+        f"📦 Среднее количество: x{rollup.average_quantity:.1f}",
+        "",
+        "*Распределение количества:*",
+    ]
+    for quantity, seen in sorted(rollup.quantities.items()):
+        lines.append(f"x{quantity}: {seen} ({seen / rollup.appearances:.0%})")
+    return "\n".join(lines)
+
+async def history_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not update.effective_user or not update.effective_message:
+        return
+    
+    if not restock_history.rollups:
+        await update.effective_message.reply_text("📭 *История стоков пока пуста*", parse_mode=ParseMode.MARKDOWN)
+        return
+    
+    if context.args:
+        item_name = item_resolver.resolve(" ".join(context.args))
+        rollup = restock_history.rollups.get(item_name) if item_name else None
+        if rollup is None:
+            await update.effective_message.reply_text("❌ *Предмет не найден в истории*", parse_mode=ParseMode.MARKDOWN)
+            return
+        await update.effective_message.reply_text(format_item_history(item_name, rollup), parse_mode=ParseMode.MARKDOWN)
+        return
+    
+    now = time.time()
+    lines = [f"🗂️ *ИСТОРИЯ СТОКОВ* ({restock_history.restocks} restock)", ""]
+    for item_name, rollup in sorted(restock_history.rollups.items(), key=lambda entry: -entry[1].last_seen):
+        item_info = ITEMS_DATA.get(item_name, {"emoji": "📦"})
+        average_interval = rollup.average_interval
+        interval_text = f", раз в {format_duration(average_interval)}" if average_interval is not None else ""
+        lines.append(
+            f"{item_info['emoji']} *{item_name}*: {format_duration(now - rollup.last_seen)} назад, "
+            f"{rollup.appearances} раз{interval_text}"
+        )
+    lines.append("")
+    lines.append("💡 /history <предмет> - подробно")
+    await update.effective_message.reply_text("\n".join(lines), parse_mode=ParseMode.MARKDOWN)
+
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not update.effective_message or not update.effective_user:
         return
@@ -925,6 +2637,7 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "📚 *СПРАВКА*\n\n"
         "📊 /stock - Текущий сток\n"
         "🔔 /autostock - Управление автостоками\n"
+        "🗂️ /history - История стоков\n"
         "❓ /help - Эта справка\n\n"
         "*Автостоки:*\n"
         "Добавьте предметы в автостоки, и вы получите уведомление, "
@@ -935,6 +2648,30 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     await update.effective_message.reply_text(help_text, parse_mode=ParseMode.MARKDOWN)
 
+def schedule_markup_edit(bot: Bot, chat_id: int, message_id: int, markup: InlineKeyboardMarkup):
+    """Схлопывает частые нажатия: в Telegram уходит только последнее состояние клавиатуры"""
+    key = (chat_id, message_id)
+    in_flight = key in pending_markup_edits
+    pending_markup_edits[key] = markup
+    if not in_flight:
+        asyncio.create_task(flush_markup_edits(bot, key))
+
+async def flush_markup_edits(bot: Bot, key: Tuple[int, int]):
+    sent = None
+    try:
+        while True:
+            markup = pending_markup_edits[key]
+            # Клавиатуры мемоизированы, поэтому совпадение состояния — это тот же объект
+            if markup is sent:
+                return
+            try:
+                await bot.edit_message_reply_markup(chat_id=key[0], message_id=key[1], reply_markup=markup)
+            except TelegramError:
+                pass
+            sent = markup
+    finally:
+        pending_markup_edits.pop(key, None)
+
 async def autostock_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
@@ -944,45 +2681,23 @@ async def autostock_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
     
     try:
         if data == "as_seeds":
-            user_items = await parser.db.load_user_autostocks(user_id, use_cache=True)
-            keyboard = []
-            for item_name, item_info in SEED_ITEMS_LIST:
-                is_tracking = item_name in user_items
-                status = "✅" if is_tracking else "➕"
-                safe_callback = NAME_TO_ID.get(item_name, "invalid")
-                keyboard.append([InlineKeyboardButton(
-                    f"{status} {item_info['emoji']} {item_name} - {item_info['price']}",
-                    callback_data=safe_callback
-                )])
-            keyboard.append([InlineKeyboardButton("⬅️ Назад", callback_data="as_back")])
-            
+            user_mask = await parser.db.load_user_autostocks(user_id, use_cache=True)
             await query.edit_message_text(
                 "🌱 *СЕМЕНА*\n\nНажмите чтобы добавить/убрать:",
-                reply_markup=InlineKeyboardMarkup(keyboard),
+                reply_markup=get_autostock_keyboard('seed', user_mask),
                 parse_mode=ParseMode.MARKDOWN
             )
         
         elif data == "as_gear":
-            user_items = await parser.db.load_user_autostocks(user_id, use_cache=True)
-            keyboard = []
-            for item_name, item_info in GEAR_ITEMS_LIST:
-                is_tracking = item_name in user_items
-                status = "✅" if is_tracking else "➕"
-                safe_callback = NAME_TO_ID.get(item_name, "invalid")
-                keyboard.append([InlineKeyboardButton(
-                    f"{status} {item_info['emoji']} {item_name} - {item_info['price']}",
-                    callback_data=safe_callback
-                )])
-            keyboard.append([InlineKeyboardButton("⬅️ Назад", callback_data="as_back")])
-            
+            user_mask = await parser.db.load_user_autostocks(user_id, use_cache=True)
             await query.edit_message_text(
                 "⚔️ *СНАРЯЖЕНИЕ*\n\nНажмите чтобы добавить/убрать:",
-                reply_markup=InlineKeyboardMarkup(keyboard),
+                reply_markup=get_autostock_keyboard('gear', user_mask),
                 parse_mode=ParseMode.MARKDOWN
             )
         
         elif data == "as_list":
-            user_items = await parser.db.load_user_autostocks(user_id, use_cache=True)
+            user_items = mask_to_items(await parser.db.load_user_autostocks(user_id, use_cache=True))
             if not user_items:
                 message = "📋 *МОИ АВТОСТОКИ*\n\n_Нет отслеживаемых предметов_"
             else:
@@ -1010,61 +2725,152 @@ async def autostock_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
                 return
             
             category = ITEMS_DATA.get(item_name, {}).get('category', 'seed')
-            user_items = await parser.db.load_user_autostocks(user_id, use_cache=True)
+            user_mask = await parser.db.load_user_autostocks(user_id, use_cache=True)
+            bit = ITEM_BITS[item_name]
             
-            if item_name in user_items:
-                user_items.discard(item_name)
-                asyncio.create_task(parser.db.remove_user_autostock(user_id, item_name))
+            if user_mask & bit:
+                user_mask &= ~bit
+                parser.db.set_user_autostock(user_id, item_name, False)
                 await query.answer(f"❌ {item_name} убран", show_alert=False)
             else:
-                user_items.add(item_name)
-                asyncio.create_task(parser.db.save_user_autostock(user_id, item_name))
+                user_mask |= bit
+                parser.db.set_user_autostock(user_id, item_name, True)
                 await query.answer(f"✅ {item_name} добавлен", show_alert=False)
             
-            items_list = SEED_ITEMS_LIST if category == 'seed' else GEAR_ITEMS_LIST
-            keyboard = []
-            for name, info in items_list:
-                is_tracking = name in user_items
-                status = "✅" if is_tracking else "➕"
-                safe_callback = NAME_TO_ID.get(name, "invalid")
-                keyboard.append([InlineKeyboardButton(
-                    f"{status} {info['emoji']} {name} - {info['price']}",
-                    callback_data=safe_callback
-                )])
-            keyboard.append([InlineKeyboardButton("⬅️ Назад", callback_data="as_back")])
-            
-            try:
-                await query.edit_message_reply_markup(reply_markup=InlineKeyboardMarkup(keyboard))
-            except TelegramError:
-                pass
+            markup = get_autostock_keyboard(category, user_mask)
+            if query.message:
+                schedule_markup_edit(context.bot, query.message.chat_id, query.message.message_id, markup)
+            else:
+                try:
+                    await query.edit_message_reply_markup(reply_markup=markup)
+                except TelegramError:
+                    pass
     
     except Exception as e:
         logger.error(f"❌ Callback: {e}")
 
-# ========== FLASK ==========
-flask_app = Flask(__name__)
-
-@flask_app.route("/", methods=["GET", "HEAD"])
-@flask_app.route("/ping", methods=["GET", "HEAD"])
-def ping():
-    if flask_request.method == "HEAD":
-        return "", 200
+# ========== HTTP СЕРВЕР ==========
+# aiohttp на том же event loop: обработчики читают состояние бота без межпоточных гонок
+async def ping_handler(request: web.Request) -> web.Response:
+    if request.method == "HEAD":
+        return web.Response(status=200)
     
-    return jsonify({
+    return web.json_response({
         "status": "ok",
         "time": datetime.utcnow().isoformat() + "Z",
         "moscow_time": get_moscow_time().strftime("%H:%M:%S"),
         "bot": "PVB Stock Tracker v3.2 FIXED",
         "discord": discord_client.is_ready() if discord_client else False,
-        "cache_size": len(user_autostocks_cache)
-    }), 200
+        "cache_size": len(user_autostocks_cache),
+        "subscriptions": len(subscriber_index),
+        "dispatch_queue": notification_dispatcher.queue.qsize(),
+        "broadcast_queue": broadcast_dispatcher.queue.qsize(),
+        "tasks": len(asyncio.all_tasks()),
+        "startup": startup_timings
+    })
 
-@flask_app.route("/health", methods=["GET"])
-def health():
-    return jsonify({
+async def health_handler(request: web.Request) -> web.Response:
+    return web.json_response({
         "status": "healthy",
         "discord": discord_client.is_ready() if discord_client else False
-    }), 200
+    })
+
+async def metrics_handler(request: web.Request) -> web.Response:
+    return web.Response(text=metrics.render(), content_type="text/plain")
+
+async def telegram_webhook_handler(request: web.Request) -> web.Response:
+    secret = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    if not hmac.compare_digest(secret, WEBHOOK_SECRET):
+        return web.Response(status=403)
+    
+    if not telegram_app:
+        return web.Response(status=503)
+    
+    try:
+        data = await request.json()
+    except ValueError:
+        return web.Response(status=400)
+    if not data:
+        return web.Response(status=400)
+    
+    # Апдейт сразу уходит в очередь Application
+    await telegram_app.update_queue.put(Update.de_json(data, telegram_app.bot))
+    return web.Response(status=200)
+
+def build_http_app() -> web.Application:
+    app = web.Application()
+    app.router.add_get("/", ping_handler)
+    app.router.add_get("/ping", ping_handler)
+    app.router.add_get("/health", health_handler)
+    app.router.add_get("/metrics", metrics_handler)
+    app.router.add_post(WEBHOOK_PATH, telegram_webhook_handler)
+    return app
+
+async def start_http_server() -> web.AppRunner:
+    port = int(os.getenv("PORT", "5000"))
+    runner = web.AppRunner(build_http_app(), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "0.0.0.0", port).start()
+    logger.info(f"🚀 HTTP сервер запущен на порту {port}")
+    return runner
+
+# ========== ФОНОВЫЕ ЗАДАЧИ ==========
+async def subscriber_index_loop():
+    """Первичная загрузка индекса подписчиков и периодическая сверка с Supabase"""
+    while True:
+        try:
+            if not await parser.db.reload_subscriber_index():
+                logger.warning("⚠️ Сверка индекса подписчиков не удалась")
+        except Exception as e:
+            logger.error(f"❌ subscriber_index_loop: {e}")
+        
+        # Пока индекс не загружен, повторяем чаще
+        await asyncio.sleep(SUBSCRIBER_INDEX_RECONCILE_SECONDS if subscriber_index.loaded else 30)
+
+async def users_flush_loop():
+    """Периодический сброс write-behind буфера пользователей"""
+    while True:
+        await asyncio.sleep(USERS_FLUSH_SECONDS)
+        try:
+            await parser.db.flush_users()
+        except Exception as e:
+            logger.error(f"❌ users_flush_loop: {e}")
+
+async def warm_up_caches():
+    """Прогрев кэшей после старта: сток из Discord и подписки недавно активных пользователей"""
+    async def warm_stock():
+        with startup_phase("Discord"):
+            await discord_client.wait_until_ready()
+        with startup_phase("Прогрев стока"):
+            await discord_client.fetch_latest_stock()
+    
+    async def warm_subscriptions():
+        await telegram_ready.wait()
+        with startup_phase("Прогрев подписок"):
+            user_ids = await parser.db.get_recent_users(WARMUP_SUBSCRIPTION_USERS)
+            semaphore = asyncio.Semaphore(WARMUP_CONCURRENCY)
+            
+            async def warm(user_id: int):
+                async with semaphore:
+                    await check_subscription(user_id, notify_bot)
+            
+            await asyncio.gather(*(warm(user_id) for user_id in user_ids), return_exceptions=True)
+            logger.info(f"🔥 Подписки прогреты: {len(user_ids)} пользователей")
+    
+    async def warm_fanout_workers():
+        if fanout_pool is None:
+            return
+        with startup_phase("Процессы fan-out"):
+            # Одновременные задачи заставляют пул поднять все процессы заранее
+            loop = asyncio.get_running_loop()
+            await asyncio.gather(*(
+                loop.run_in_executor(fanout_pool, fanout_worker_ping) for _ in range(FANOUT_WORKER_PROCESSES)
+            ))
+    
+    results = await asyncio.gather(warm_stock(), warm_subscriptions(), warm_fanout_workers(), return_exceptions=True)
+    for result in results:
+        if isinstance(result, Exception):
+            logger.error(f"❌ warm_up_caches: {result}")
 
 # ========== ИНИЦИАЛИЗАЦИЯ ==========
 async def post_init(application: Application):
@@ -1080,16 +2886,29 @@ def main():
     logger.info("="*60)
     
     build_item_id_mappings()
+    build_item_resolver()
+    restock_dedup.load()
     
-    global discord_client, telegram_app
+    global discord_client, telegram_app, notify_bot
     
     discord_client = PVBDiscordClient()
-    telegram_app = Application.builder().token(BOT_TOKEN).build()
+    # Команды и кнопки: свой пул, приоритет в общем лимите и параллельная обработка апдейтов
+    telegram_app = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .connection_pool_size(INTERACTIVE_POOL_SIZE)
+        .rate_limiter(InteractiveRateLimiter())
+        .concurrent_updates(True)
+        .build()
+    )
+    notify_bot = Bot(BOT_TOKEN, request=HTTPXRequest(connection_pool_size=NOTIFY_POOL_SIZE))
     
     telegram_app.add_handler(CommandHandler("start", start_command))
     telegram_app.add_handler(CommandHandler("stock", stock_command))
     telegram_app.add_handler(CommandHandler("autostock", autostock_command))
     telegram_app.add_handler(CommandHandler("stats", stats_command))
+    telegram_app.add_handler(CommandHandler("history", history_command))
+    telegram_app.add_handler(CommandHandler("broadcast", broadcast_command))
     telegram_app.add_handler(CommandHandler("help", help_command))
     telegram_app.add_handler(CallbackQueryHandler(check_subscription_callback, pattern="^check_subscription$"))
     telegram_app.add_handler(CallbackQueryHandler(autostock_callback, pattern="^as_|^t_"))
@@ -1098,6 +2917,17 @@ def main():
     
     async def shutdown_callback(app: Application):
         logger.info("🛑 Остановка бота...")
+        if broadcast_job and broadcast_job.running:
+            # Контрольная точка сохраняется при отмене задачи
+            broadcast_job.task.cancel()
+            await asyncio.gather(broadcast_job.task, return_exceptions=True)
+        await broadcast_dispatcher.stop()
+        await notification_dispatcher.stop()
+        if fanout_pool is not None:
+            fanout_pool.shutdown(wait=False, cancel_futures=True)
+        await parser.db.flush_users()
+        await parser.db.flush_all_toggles()
+        await restock_history.close()
         if discord_client:
             await discord_client.close()
         if http_session and not http_session.closed:
@@ -1105,25 +2935,66 @@ def main():
     
     telegram_app.post_shutdown = shutdown_callback
     
+    async def start_updates() -> str:
+        """Webhook, если задан WEBHOOK_URL, иначе long polling"""
+        if WEBHOOK_URL:
+            webhook_url = WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH
+            try:
+                await telegram_app.bot.set_webhook(
+                    url=webhook_url,
+                    secret_token=WEBHOOK_SECRET,
+                    allowed_updates=Update.ALL_TYPES,
+                    drop_pending_updates=True
+                )
+                logger.info(f"✅ Telegram webhook установлен: {webhook_url}")
+                return "webhook"
+            except TelegramError as e:
+                logger.error(f"❌ Не удалось установить webhook, переход на polling: {e}")
+        
+        await telegram_app.updater.start_polling(allowed_updates=None, drop_pending_updates=True)
+        logger.info("✅ Telegram polling запущен")
+        return "polling"
+    
     async def run_both():
-        # Запускаем Discord в фоне
-        discord_task = asyncio.create_task(discord_client.start(DISCORD_TOKEN))
+        global telegram_ready
+        started = time.perf_counter()
+        telegram_ready = asyncio.Event()
+        
+        # Render останавливает сервис и передеплоит его по SIGTERM: отменяем главную задачу,
+        # чтобы finally сбросил буферы пользователей, переключения и контрольную точку рассылки
+        main_task = asyncio.current_task()
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, main_task.cancel)
         
-        # Ждем подключения Discord
-        while not discord_client.is_ready():
-            await asyncio.sleep(0.5)
+        with startup_phase("HTTP сервер"):
+            http_runner = await start_http_server()
         
-        logger.info("✅ Discord клиент готов к работе")
+        with startup_phase("История стоков"):
+            await restock_history.open()
+            # До первого restock /stock отвечает последним стоком из истории
+            try:
+                latest = restock_history.latest_stock()
+                if latest and not stock_cache:
+                    updated, stock_data = latest
+                    update_stock_cache(stock_data, updated=updated)
+            except Exception as e:
+                logger.error(f"❌ Не удалось восстановить сток из истории: {e}", exc_info=True)
         
-        # Теперь инициализируем и запускаем Telegram
-        await telegram_app.initialize()
-        logger.info("✅ Telegram app инициализирован")
+        start_fanout_pool()
         
-        await telegram_app.start()
-        logger.info("✅ Telegram app запущен")
+        # Discord и Telegram стартуют одновременно: команды не ждут подключения к Discord
+        discord_task = asyncio.create_task(discord_client.start(DISCORD_TOKEN))
+        background_tasks.append(asyncio.create_task(warm_up_caches()))
+        background_tasks.append(asyncio.create_task(subscriber_index_loop()))
+        background_tasks.append(asyncio.create_task(users_flush_loop()))
+        background_tasks.append(asyncio.create_task(resume_broadcast()))
         
-        await telegram_app.updater.start_polling(allowed_updates=None, drop_pending_updates=True)
-        logger.info("✅ Telegram polling запущен")
+        with startup_phase("Telegram"):
+            await asyncio.gather(telegram_app.initialize(), notify_bot.initialize())
+            await post_init(telegram_app)
+            await telegram_app.start()
+            updates_mode = await start_updates()
+        telegram_ready.set()
+        startup_timings["Всего до приёма команд"] = round(time.perf_counter() - started, 3)
         
         logger.info("="*60)
         logger.info("🚀 БОТ УСПЕШНО ЗАПУЩЕН!")
@@ -1131,28 +3002,30 @@ def main():
         logger.info(f"📢 Обязательные каналы: {', '.join(REQUIRED_CHANNELS)}")
         logger.info(f"📡 Discord канал стоков: {DISCORD_STOCK_CHANNEL_ID}")
         logger.info(f"🤖 Telegram bot: @{telegram_app.bot.username}")
+        logger.info(f"📥 Получение апдейтов: {updates_mode}")
         logger.info(f"🔗 Telegram bot установлен в parser: {parser.telegram_bot is not None}")
+        logger.info(f"⏱️ Фазы запуска: {startup_timings}")
         logger.info("="*60)
         
         try:
             await discord_task
-        except KeyboardInterrupt:
-            pass
+        except (KeyboardInterrupt, asyncio.CancelledError):
+            logger.info("⚠️ Получен сигнал остановки")
+            # Отмена поглощена: ожидания в finally не должны считаться отменёнными
+            main_task.uncancel()
         finally:
-            await telegram_app.updater.stop()
+            for task in background_tasks:
+                task.cancel()
+            if telegram_app.updater.running:
+                await telegram_app.updater.stop()
             await telegram_app.stop()
             await telegram_app.shutdown()
-    
-    def run_flask_server():
-        port = int(os.getenv("PORT", "5000"))
-        logger.info(f"🚀 Flask сервер запущен на порту {port}")
-        import logging as flask_logging
-        flask_log = flask_logging.getLogger('werkzeug')
-        flask_log.setLevel(flask_logging.ERROR)
-        flask_app.run(host="0.0.0.0", port=port, threaded=True, use_reloader=False)
-    
-    flask_thread = threading.Thread(target=run_flask_server, daemon=True)
-    flask_thread.start()
+            # post_shutdown сам вызывается только из run_polling/run_webhook
+            await shutdown_callback(telegram_app)
+            await notify_bot.shutdown()
+            await http_runner.cleanup()
+            if not discord_client.is_closed():
+                await discord_client.close()
     
     try:
         asyncio.run(run_both())